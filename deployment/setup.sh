@@ -38,6 +38,10 @@ cat `pwd`/deployment/nginx.conf | \
 	cat - > /tmp/site.conf \
 	&& sudo mv /tmp/site.conf /etc/nginx/sites-enabled/site.conf
 
+# Make the directory for nginx's page cache.
+sudo mkdir -p /var/cache/nginx/site
+sudo chown www-data /var/cache/nginx/site
+
 # Install TLS cert provisioning tool.
 sudo apt-get install -y build-essential libssl-dev libffi-dev python3-dev python3-pip
 sudo -H pip3 install free_tls_certificates
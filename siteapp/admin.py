@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Organization, Campaign, Contribution
+from .models import Organization, Campaign, Contribution, PaymentJob, OutgoingReceipt, VoidJob, IdempotencyKey
 
 class OrganizationAdmin(admin.ModelAdmin):
 	list_display = ['name', 'slug', 'created']
@@ -9,60 +9,138 @@ class OrganizationAdmin(admin.ModelAdmin):
 admin.site.register(Organization, OrganizationAdmin)
 
 class CampaignAdmin(admin.ModelAdmin):
-	list_display = ['title', 'slug', 'owner', 'active', 'created', 'total_contributors', 'total_contributions']
+	list_display = ['title', 'slug', 'owner', 'active', 'created', 'current_total_contributors', 'current_total_contributions']
 	search_fields = ['title', 'slug', 'owner']
 	raw_id_fields = ['owner']
-	readonly_fields = ['total_contributors', 'total_contributions']
+	readonly_fields = ['total_contributors', 'total_contributions', 'current_total_contributors', 'current_total_contributions']
+
+	def get_queryset(self, request):
+		# Add in the changes that haven't been folded into the totals yet.
+		from django.db.models import Sum
+		return super(CampaignAdmin, self).get_queryset(request).annotate(
+			pending_contributors=Sum('counter_shards__contributors'),
+			pending_contributions=Sum('counter_shards__contributions'))
+
+	def current_total_contributors(self, obj):
+		return obj.total_contributors + (obj.pending_contributors or 0)
+
+	def current_total_contributions(self, obj):
+		return obj.total_contributions + (obj.pending_contributions or 0)
+
+	# Download the contributions to the selected campaigns, one row per
+	# line item, streamed so that large campaigns don't use up memory.
+	actions = ['export_contributions_csv', 'export_contributions_jsonl']
+	def export_contributions(modeladmin, request, queryset, format):
+		from .export import streaming_export_response
+		campaign_ids = list(queryset.values_list('id', flat=True))
+		return streaming_export_response(
+			Contribution.objects.filter(campaign_id__in=campaign_ids),
+			format,
+			"contributions-" + "-".join(str(id) for id in campaign_ids[:10]))
+
+	def export_contributions_csv(modeladmin, request, queryset):
+		return modeladmin.export_contributions(request, queryset, "csv")
+	export_contributions_csv.short_description = "Export contributions as CSV"
+
+	def export_contributions_jsonl(modeladmin, request, queryset):
+		return modeladmin.export_contributions(request, queryset, "jsonl")
+	export_contributions_jsonl.short_description = "Export contributions as JSON Lines"
 
 admin.site.register(Campaign, CampaignAdmin)
 
 class ContributionAdmin(admin.ModelAdmin):
-	list_display = ['id', 'campaign', 'contributor_summary', 'amount', 'ref_code', 'status', 'created']
+	list_display = ['id', 'campaign', 'contributor_email', 'contributor_name', 'contributor_state', 'amount', 'ref_code', 'status', 'created']
+	list_select_related = ['campaign', 'campaign__owner']
 	raw_id_fields = ['campaign']
-	search_fields = ['cclastfour']
-
-	def status(self, obj):
-		status = []
-		if not obj.transaction:
-			status.append("no transaction")
-		elif obj.transaction.get("error"):
-			status.append("ERROR")
-		if obj.extra and obj.extra.get("void"):
-			status.append( "/".join(v.get("method") or "ERROR" for v in obj.extra["void"]) )
-		if obj.extra and obj.extra.get("error_sending_receipt"):
-			status.append("receipt email error")
-		if len(status) == 0: status.append("ok")
-		return ", ".join(status)
+	search_fields = ['cclastfour', '=contributor_zip']
+	list_filter = ['status', 'contributor_state']
+	readonly_fields = ['status']
+
+	def get_search_results(self, request, queryset, search_term):
+		# Contributor emails and names are stored normalized, so look them
+		# up exactly or by prefix, which can use their indexes. A name
+		# matches the start of the first and last name or of the last name.
+		from .models import normalize_email, normalize_name
+		if "@" in search_term:
+			return queryset.filter(contributor_email=normalize_email(search_term)), False
+		results, use_distinct = super(ContributionAdmin, self).get_search_results(request, queryset, search_term)
+		if normalize_name(search_term):
+			results |= queryset.filter(contributor_name__startswith=normalize_name(search_term))
+			results |= queryset.filter(contributor_last_name__startswith=normalize_name(search_term))
+		return results, use_distinct
+
+	def get_changelist(self, request, **kwargs):
+		# Only load the columns shown in the list, leaving out the large
+		# JSON columns.
+		from django.contrib.admin.views.main import ChangeList
+		class ContributionChangeList(ChangeList):
+			def get_queryset(self, request):
+				return super(ContributionChangeList, self).get_queryset(request).only(
+					'id', 'contributor_email', 'contributor_name', 'contributor_state',
+					'amount', 'ref_code', 'status', 'created',
+					'campaign__id', 'campaign__title', 'campaign__owner__id', 'campaign__owner__name')
+		return ContributionChangeList
 
 	# remove the Delete action?, add our void action
 	actions = ['void', 'send_receipt']
 	def void(modeladmin, request, queryset):
-		# Void selected pledge executions. Collect return
-		# values and exceptions.
-		voids = []
-		for c in queryset:
-			try:
-				voids.append([c.id, c.void()])
-			except Exception as e:
-				voids.append([c.id, str(e)])
-		return json_response(voids)
+		# Void selected pledge executions. Voiding is slow, so queue a
+		# job for the execute_voids command and show its progress.
+		from django.http import HttpResponseRedirect
+		from django.urls import reverse
+		job = VoidJob.objects.create(results=[[id, None] for id in queryset.order_by('id').values_list('id', flat=True)])
+		modeladmin.message_user(request, "Voiding %d contributions in the background." % len(job.results))
+		return HttpResponseRedirect(reverse('admin:siteapp_voidjob_change', args=[job.id]))
 
 	def send_receipt(modeladmin, request, queryset):
 		from .views import send_receipt as do_send_receipt
+		from django.core.mail import get_connection
 		response = []
-		for c in queryset:
-			try:
-				response.append( (c.id, do_send_receipt(c)) )
-			except Exception as e:
-				response.append( (c.id, str(e)) )
+		# Send over one connection to the mail server.
+		with get_connection() as connection:
+			for c in queryset.defer(None).select_related('campaign'):
+				try:
+					response.append( (c.id, do_send_receipt(c, connection)) )
+				except Exception as e:
+					response.append( (c.id, str(e)) )
 		return json_response(response)
 
 
 admin.site.register(Contribution, ContributionAdmin)
 
+class PaymentJobAdmin(admin.ModelAdmin):
+	list_display = ['id', 'contribution', 'state', 'attempts', 'run_after', 'created']
+	list_filter = ['state']
+	raw_id_fields = ['contribution']
+	exclude = ['payment'] # never show credit card information
+	readonly_fields = ['key', 'attempts', 'claimed_at', 'result']
+
+admin.site.register(PaymentJob, PaymentJobAdmin)
+
+class OutgoingReceiptAdmin(admin.ModelAdmin):
+	list_display = ['id', 'contribution', 'attempts', 'send_after', 'created']
+	raw_id_fields = ['contribution']
+	readonly_fields = ['last_error']
+
+admin.site.register(OutgoingReceipt, OutgoingReceiptAdmin)
+
+class VoidJobAdmin(admin.ModelAdmin):
+	list_display = ['id', 'state', 'progress', 'created', 'updated']
+	list_filter = ['state']
+	readonly_fields = ['state', 'progress', 'results', 'claimed_at', 'created', 'updated']
+
+admin.site.register(VoidJob, VoidJobAdmin)
+
 def json_response(data):
 	import json
 	from django.http import HttpResponse
 	response = HttpResponse(content_type="application/json")
 	json.dump(data, response)
 	return response
+
+class IdempotencyKeyAdmin(admin.ModelAdmin):
+	list_display = ['id', 'key', 'campaign', 'created']
+	raw_id_fields = ['campaign']
+	readonly_fields = ['key', 'response', 'created']
+
+admin.site.register(IdempotencyKey, IdempotencyKeyAdmin)
@@ -1,15 +1,37 @@
 import decimal
 import json
+import sys
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests.packages.urllib3.util.retry import Retry
+
+from .metrics import Counter, Histogram
+
+# Metrics for calls to the API, by API method ("meta" for the subscriber
+# meta info). Only method names, statuses, and timings are recorded, never
+# anything from the requests or responses, which have sensitive data.
+api_calls = Counter("newco_de_calls_total", "Democracy Engine API calls, by method and outcome (ok, validation-error, http-error, timeout, connection-error, or error).")
+api_responses = Counter("newco_de_responses_total", "Democracy Engine API responses, by method and HTTP status.")
+api_seconds = Histogram("newco_de_call_seconds", "Time taken by Democracy Engine API calls, including retries, by method.")
 
 class HumanReadableValidationError(Exception):
 	pass
 
-class DemocracyEngineAPIClient(object):
-	de_meta_info = None
+class GetOnlyRetry(Retry):
+	# Like Retry, but failures to connect are also only retried for the
+	# methods in method_whitelist. Retry otherwise retries them for any
+	# method, which would let a single POST take several timeouts.
+	def increment(self, method=None, *args, **kwargs):
+		if method is not None and method.upper() not in self.method_whitelist:
+			return Retry(0, read=False).increment(method, *args, **kwargs)
+		return super(GetOnlyRetry, self).increment(method, *args, **kwargs)
 
-	def __init__(self, api_baseurl, account_number, username, password, fees_recipient_id):
+class DemocracyEngineAPIClient(object):
+	def __init__(self, api_baseurl, account_number, username, password, fees_recipient_id,
+		pool_size=10, keep_alive=True, get_retries=3, meta_cache=None, meta_cache_ttl=60*60*24):
 		self.api_baseurl = api_baseurl
 		self.account_number = account_number
 		self.username = username
@@ -17,22 +39,52 @@ class DemocracyEngineAPIClient(object):
 		self.fees_recipient_id = fees_recipient_id
 		self.debug = False
 
-	def __call__(self, method, post_data=None, argument=None, live_request=False, http_method=None):
-
-		# Cache meta info. If method is None, don't infinite recurse.
-		if (self.de_meta_info == None) and (method is not None):
-			self.de_meta_info = self(None, None, live_request=live_request)
+		# The subscriber meta info has the URLs for all of the other API
+		# calls. It's fetched once and kept for meta_cache_ttl seconds,
+		# both here and in meta_cache (a Django cache) if given, so that
+		# it's shared with other processes.
+		self.de_meta_info = None
+		self.de_meta_info_expires = None
+		self.de_meta_info_lock = threading.Lock()
+		self.meta_cache = meta_cache
+		self.meta_cache_ttl = meta_cache_ttl
+
+		# Make all requests through a session so that connections are pooled
+		# and kept alive between calls rather than paying for a new TCP and
+		# TLS handshake each time. pool_size is the most connections kept
+		# open at once, which should be at least the number of threads
+		# making calls at once.
+		#
+		# Only GET requests, which only read data, are retried. Other requests
+		# might have gone through the first time, and even a failure to
+		# connect isn't retried so that a POST, which the user may be
+		# waiting on, takes at most one timeout.
+		self.session = requests.Session()
+		adapter = HTTPAdapter(
+			pool_connections=1,
+			pool_maxsize=pool_size,
+			max_retries=GetOnlyRetry(
+				total=get_retries,
+				backoff_factor=0.5,
+				method_whitelist=frozenset(['GET']),
+			))
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+		if not keep_alive:
+			self.session.headers['Connection'] = 'close'
+
+	def __call__(self, method, post_data=None, argument=None, live_request=False, http_method=None, params=None):
 
 		if method is None:
 			# This is an internal call to get the meta subscriber info.
 			url = self.api_baseurl + ('/subscribers/%s.json' % self.account_number)
 		elif method == "META":
 			# This is a real call to get the meta info, which is always cached.
-			return self.de_meta_info
+			return self.get_meta_info(live_request=live_request)
 		else:
 			# Get the correct URL from the meta info, and do argument substitution
 			# if necessary.
-			url = self.de_meta_info[method + "_uri"]
+			url = self.get_meta_info(live_request=live_request)[method + "_uri"]
 			if argument:
 				import urllib.parse
 				url = url.replace(":"+argument[0], urllib.parse.quote(argument[1]))
@@ -41,66 +93,132 @@ class DemocracyEngineAPIClient(object):
 		if post_data == None:
 			payload = None
 			headers = None
-			urlopen = requests.get
+			urlopen = self.session.get
 		else:
 			payload = json.dumps(post_data)
 			headers = {'content-type': 'application/json'}
-			urlopen = requests.post
+			urlopen = self.session.post
 
 		# Override HTTP method.
 		if http_method:
-			urlopen = getattr(requests, http_method)
+			urlopen = getattr(self.session, http_method)
 
-		# Log requests. Definitely don't do this in production since we'll
-		# have sensitive data here!
+		# Log requests, but only the method and URL since the payloads have
+		# sensitive data.
 		if self.debug:
 			print(urlopen.__name__.upper(), url)
-			if payload:
-				print(json.dumps(json.loads(payload), indent=True))
-			print()
-
-		# issue request
-		r = urlopen(
-			url,
-			auth=HTTPBasicAuth(self.username, self.password),
-			data=payload,
-			headers=headers,
-			timeout=60 if not live_request else 20,
-			verify=True, # check SSL cert (is default, actually)
-			)
 
-		# raises exception on anything but 200 OK
+		metric_method = method or "meta"
+		outcome = "error"
+		start = time.perf_counter()
 		try:
-			r.raise_for_status()
-		except:
+			# issue request
+			r = urlopen(
+				url,
+				params=params,
+				auth=HTTPBasicAuth(self.username, self.password),
+				data=payload,
+				headers=headers,
+				timeout=60 if not live_request else 20,
+				verify=True, # check SSL cert (is default, actually)
+				)
+			api_responses.inc(method=metric_method, status=r.status_code)
+
+			# raises exception on anything but 200 OK
 			try:
-				exc = r.json()
-				if isinstance(exc, list) and len(exc) > 0 and exc[0][0] == "base":
-					# Not sure what 'base' means, but we get things like
-					# "Card number is not a valid credit card number".
-					raise HumanReadableValidationError(exc[0][1])
-				if isinstance(exc, dict) and isinstance(exc.get('base'), list):
-					# Not sure what 'base' means, but we get things like
-					# "Card number is not a valid credit card number".
-					raise HumanReadableValidationError(exc.get('base')[0])
-			except HumanReadableValidationError:
-				raise # pass through/up
+				r.raise_for_status()
 			except:
-				pass # fall through to next
-
-			import sys
-			print(urlopen.__name__.upper(), url)
-			if payload: print(payload)
-			print()
-			print(r.content, file=sys.stderr)
-			raise IOError("DemocrayEngine API failed: %d %s" % (r.status_code, url))
-
-		# The PUT requests have no response. A 200 response is success.
-		if http_method == "put":
-			return None
-
-		# all other responses are JSON
-		return r.json()
+				try:
+					exc = r.json()
+					if isinstance(exc, list) and len(exc) > 0 and exc[0][0] == "base":
+						# Not sure what 'base' means, but we get things like
+						# "Card number is not a valid credit card number".
+						raise HumanReadableValidationError(exc[0][1])
+					if isinstance(exc, dict) and isinstance(exc.get('base'), list):
+						# Not sure what 'base' means, but we get things like
+						# "Card number is not a valid credit card number".
+						raise HumanReadableValidationError(exc.get('base')[0])
+				except HumanReadableValidationError:
+					raise # pass through/up
+				except:
+					pass # fall through to next
+
+				# Don't print the request or response, which may have
+				# sensitive data.
+				outcome = "http-error"
+				print("Democracy Engine API failed:", urlopen.__name__.upper(), url, r.status_code, file=sys.stderr)
+				raise IOError("DemocrayEngine API failed: %d %s" % (r.status_code, url))
+
+			# The PUT requests have no response. A 200 response is success.
+			# All other responses are JSON.
+			ret = r.json() if http_method != "put" else None
+			outcome = "ok"
+			return ret
+
+		except HumanReadableValidationError:
+			outcome = "validation-error"
+			raise
+		except requests.exceptions.Timeout:
+			outcome = "timeout"
+			raise
+		except requests.exceptions.ConnectionError:
+			outcome = "connection-error"
+			raise
+		finally:
+			api_seconds.observe(time.perf_counter() - start, method=metric_method)
+			api_calls.inc(method=metric_method, outcome=outcome)
+
+	def get_meta_info(self, live_request=False):
+		# Return the subscriber meta info, from our own copy, the shared
+		# cache, or by fetching it. Concurrent callers in this process wait
+		# for a single fetch, and callers in other processes wait briefly
+		# for it to appear in the shared cache.
+		if self.de_meta_info is not None and time.time() < self.de_meta_info_expires:
+			return self.de_meta_info
+		with self.de_meta_info_lock:
+			# Another thread may have fetched it while we waited for the lock.
+			if self.de_meta_info is not None and time.time() < self.de_meta_info_expires:
+				return self.de_meta_info
+
+			cache_key = "democracyengine:meta:%s" % self.account_number
+			meta_info = None
+			locked = False
+			if self.meta_cache is not None:
+				meta_info = self.meta_cache.get(cache_key)
+				if meta_info is None:
+					locked = self.meta_cache.add(cache_key + ":lock", True, 30)
+					if not locked:
+						# Another process is fetching it.
+						for _ in range(50):
+							time.sleep(.1)
+							meta_info = self.meta_cache.get(cache_key)
+							if meta_info is not None:
+								break
+
+			if meta_info is None:
+				try:
+					meta_info = self(None, None, live_request=live_request)
+					if self.meta_cache is not None:
+						self.meta_cache.set(cache_key, meta_info, self.meta_cache_ttl)
+				finally:
+					# Release the lock even if the fetch failed so that other
+					# processes don't wait on it.
+					if locked:
+						self.meta_cache.delete(cache_key + ":lock")
+
+			self.de_meta_info = meta_info
+			self.de_meta_info_expires = time.time() + self.meta_cache_ttl
+			return meta_info
+
+	def warm_up(self):
+		# Fetch the meta info ahead of the first API call that needs it,
+		# e.g. when a worker process starts. Failures are not fatal since
+		# the fetch will be tried again when it's needed, so use the shorter
+		# timeout for live requests to not hold up the worker for long.
+		try:
+			self.get_meta_info(live_request=True)
+		except Exception as e:
+			print("Could not fetch Democracy Engine meta info:", e, file=sys.stderr)
 
 	def recipients(self, live_request=False):
 		return self(method="recipients", live_request=live_request)
@@ -120,17 +238,20 @@ class DemocracyEngineAPIClient(object):
 	def credit_transaction(self, id):
 		return self(method="transaction_credit", argument=('transaction_id', id), http_method="put")
 
-	def donations(self, live_request=False):
-		return self(method="donations", live_request=live_request)
+	def donations(self, start_date=None, live_request=False):
+		# Pass start_date (a date) to only get donations made on or after it.
+		params = { "start_date": start_date.isoformat() } if start_date else None
+		return self(method="donations", params=params, live_request=live_request)
 
 	def get_donation(self, id, live_request=False):
 		return self(method="donation", argument=('donation_id', id), live_request=live_request)
 
-	def create_donation(self, info):
+	def create_donation(self, info, live_request=False):
 		return self(
 			method="donation_process",
 			post_data=
 				{ "donation": info },
+			live_request=live_request,
 			)
 
 	@staticmethod
@@ -162,7 +283,20 @@ class DummyDemocracyEngineAPIClient(object):
 
 	issued_tokens = set()
 
-	def create_donation(self, info):
+	def warm_up(self):
+		pass
+
+	def create_donation(self, info, live_request=False):
+		if 'cc_number' in info:
+			for field in ("donor_first_name", "donor_last_name", "donor_address1", "donor_city", "donor_state", "donor_zip",
+				"compliance_employer", "compliance_occupation",
+				"cc_number", "cc_month", "cc_year", "cc_verification_value"):
+				if not info.get(field, "").strip():
+					raise HumanReadableValidationError("Field is empty: %s" % field)
+
+			if info['cc_number'] != '4111111111111111':
+				raise HumanReadableValidationError("Invalid credit card number.")
+
 		if info.get('token_request'):
 			import random, hashlib
 			token = hashlib.md5(str(random.random()).encode('ascii')).hexdigest()
@@ -172,14 +306,6 @@ class DummyDemocracyEngineAPIClient(object):
 				"token": token,
 			}
 		elif 'cc_number' in info:
-			for field in ("donor_first_name", "donor_last_name", "donor_address1", "donor_city", "donor_state", "donor_zip",
-				"compliance_employer", "compliance_occupation",
-				"cc_number", "cc_month", "cc_year", "cc_verification_value"):
-				if not info.get(field, "").strip():
-					raise HumanReadableValidationError("Field is empty: %s" % field)
-
-			if info['cc_number'] != '4111111111111111':
-				raise HumanReadableValidationError("Invalid credit card number.")
 			return {
 				"dummy_response": True,
 			}
@@ -0,0 +1,102 @@
+# Exports Contributions for compliance reporting, with one row for each
+# line item (each recipient of each Contribution). Used by the
+# export_contributions management command and the Campaign admin.
+#
+# Contributions are loaded a chunk at a time by ID range and rows are
+# generated as they are written, so memory use doesn't grow with the
+# number of Contributions.
+
+import csv
+import json
+
+EXPORT_COLUMNS = [
+  "contribution_id",
+  "campaign_id",
+  "created",
+  "status",
+  "ref_code",
+  "contribution_amount",
+  "email",
+  "first_name",
+  "last_name",
+  "address",
+  "city",
+  "state",
+  "zip",
+  "phone",
+  "occupation",
+  "employer",
+  "recipient_id",
+  "recipient_name",
+  "recipient_type",
+  "de_recipient_id",
+  "amount",
+]
+
+def iter_contribution_rows(contributions, chunk_size=500):
+  # Generate a dict for each line item of each Contribution in the
+  # queryset, in Contribution ID order. Only the columns that go into the
+  # export are loaded, leaving out the transaction and extra JSON.
+  contributions = contributions.only(
+    'id', 'campaign_id', 'created', 'status', 'ref_code', 'amount', 'contributor', 'recipients'
+    ).order_by('id')
+  last_id = 0
+  while True:
+    chunk = list(contributions.filter(id__gt=last_id)[0:chunk_size])
+    if len(chunk) == 0:
+      break
+    for c in chunk:
+      contributor = c.contributor or { }
+      for recipient, amount in c.recipients:
+        yield {
+          "contribution_id": c.id,
+          "campaign_id": c.campaign_id,
+          "created": c.created.isoformat(),
+          "status": c.status,
+          "ref_code": c.ref_code,
+          "contribution_amount": str(c.amount),
+          "email": contributor.get("email"),
+          "first_name": contributor.get("nameFirst"),
+          "last_name": contributor.get("nameLast"),
+          "address": contributor.get("address"),
+          "city": contributor.get("city"),
+          "state": contributor.get("state"),
+          "zip": contributor.get("zip"),
+          "phone": contributor.get("phone"),
+          "occupation": contributor.get("occupation"),
+          "employer": contributor.get("employer"),
+          "recipient_id": recipient.get("id"),
+          "recipient_name": recipient.get("name"),
+          "recipient_type": recipient.get("type"),
+          "de_recipient_id": recipient.get("de_recipient_id"),
+          "amount": str(amount),
+        }
+    last_id = chunk[-1].id
+
+def iter_csv(rows):
+  # Generate the lines of a CSV file, starting with a header.
+  class Line(object):
+    def write(self, value):
+      return value
+  writer = csv.writer(Line())
+  yield writer.writerow(EXPORT_COLUMNS)
+  for row in rows:
+    yield writer.writerow([row[column] for column in EXPORT_COLUMNS])
+
+def iter_jsonl(rows):
+  # Generate the lines of a JSON Lines file, one JSON object per line.
+  for row in rows:
+    yield json.dumps(row, sort_keys=True) + "\n"
+
+EXPORT_FORMATS = {
+  "csv": (iter_csv, "text/csv"),
+  "jsonl": (iter_jsonl, "application/x-ndjson"),
+}
+
+def streaming_export_response(contributions, format, filename):
+  # Return a response that streams the export to the browser as a download.
+  from django.http import StreamingHttpResponse
+  iter_lines, content_type = EXPORT_FORMATS[format]
+  response = StreamingHttpResponse(iter_lines(iter_contribution_rows(contributions)), content_type=content_type)
+  response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (filename, format)
+  return response
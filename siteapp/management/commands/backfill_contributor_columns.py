@@ -0,0 +1,40 @@
+# Backfills the contributor look-up columns
+# -----------------------------------------
+#
+# Contribution.save() copies the contributor's email, name, last name, ZIP
+# code, and state out of the contributor JSON into indexed columns. This
+# command fills them in for Contributions saved before those columns existed.
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from siteapp.models import Contribution
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Fills in the contributor look-up columns on existing contributions.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=1000, help='The number of contributions to load at a time.')
+		parser.add_argument('--all', action='store_true', help='Update all contributions, not just ones with no contributor email or last name.')
+
+	def handle(self, *args, **options):
+		columns = ['contributor_email', 'contributor_name', 'contributor_last_name', 'contributor_zip', 'contributor_state']
+		contributions = Contribution.objects.only('id', 'contributor', *columns).order_by('id')
+		if not options['all']:
+			contributions = contributions.filter(Q(contributor_email=None) | Q(contributor_last_name=None))
+
+		# Go through by ID range so that each batch is a quick indexed query.
+		last_id = 0
+		updated = 0
+		while True:
+			batch = list(contributions.filter(id__gt=last_id)[0:options['batch_size']])
+			if len(batch) == 0:
+				break
+			for c in batch:
+				c.update_contributor_columns()
+				Contribution.objects.filter(id=c.id).update(**{ col: getattr(c, col) for col in columns })
+			updated += len(batch)
+			last_id = batch[-1].id
+
+		print("Updated", updated, "contributions.")
@@ -0,0 +1,241 @@
+# Benchmarks the contribution split and checkout paths
+# ----------------------------------------------------
+#
+# Times compute_line_items, compute_minimum_contribution, and
+# compute_maximum_contribution over a range of recipient counts, recipient
+# mixes, and amounts, and then times the preview and execute requests end
+# to end through the Django test client with the dummy Democracy Engine
+# client. Results are saved as JSON so that runs can be compared:
+#
+#   ./manage.py benchmark --output before.json
+#   ... make changes ...
+#   ./manage.py benchmark --compare before.json
+#
+# The end-to-end benchmarks create a Campaign and Contributions in a
+# transaction that is rolled back, but run this against a development
+# database, not production.
+
+import itertools
+import json
+import platform
+import random
+import time
+from decimal import Decimal
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import Client
+from django.test.utils import override_settings
+
+from siteapp import views
+from siteapp.models import alg, Organization, Campaign
+from siteapp.de import DummyDemocracyEngineAPIClient
+
+RECIPIENT_COUNTS = [5, 20, 100, 500]
+RECIPIENT_MIXES = ["candidates", "mixed", "limit-heavy"]
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Benchmarks splitting contributions among recipients and the preview/execute requests.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--output', help='Save the results as JSON to this file.')
+		parser.add_argument('--compare', help='Compare the results with a JSON file saved by an earlier run and fail if any benchmark got slower.')
+		parser.add_argument('--threshold', type=float, default=1.25, help='With --compare, how many times slower a benchmark can get before it counts as a regression.')
+		parser.add_argument('--quick', action='store_true', help='Run each benchmark for less time, for a rough result.')
+		parser.add_argument('--skip-end-to-end', action='store_true', help='Only benchmark the split functions.')
+
+	def handle(self, *args, **options):
+		self.min_time = 0.02 if options['quick'] else 0.2
+		self.repeat = 3 if options['quick'] else 5
+
+		results = []
+		for num_recipients in RECIPIENT_COUNTS:
+			for mix in RECIPIENT_MIXES:
+				results.extend(self.benchmark_split(num_recipients, mix))
+		if not options['skip_end_to_end']:
+			results.extend(self.benchmark_end_to_end())
+
+		for result in results:
+			print("%-60s %12.1f us" % (result["name"], result["median_us"]))
+
+		report = {
+			"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+			"python": platform.python_version(),
+			"django": django.get_version(),
+			"results": results,
+		}
+		if options['output']:
+			with open(options['output'], 'w') as f:
+				json.dump(report, f, indent=2, sort_keys=True)
+
+		if options['compare']:
+			self.compare(results, options['compare'], options['threshold'])
+
+	def measure(self, name, func, **info):
+		# Time func by calling it enough times for each run to take at least
+		# min_time seconds, and report the per-call time of the median and
+		# fastest runs in microseconds.
+		number = 1
+		while True:
+			start = time.perf_counter()
+			for _ in range(number):
+				func()
+			elapsed = time.perf_counter() - start
+			if elapsed >= self.min_time:
+				break
+			number *= 2 if elapsed == 0 else max(2, int(self.min_time / elapsed) + 1)
+
+		runs = [elapsed]
+		for _ in range(self.repeat - 1):
+			start = time.perf_counter()
+			for _ in range(number):
+				func()
+			runs.append(time.perf_counter() - start)
+		runs = sorted(r / number * 1000000 for r in runs)
+
+		result = { "name": name, "calls": number, "median_us": runs[len(runs)//2], "min_us": runs[0] }
+		result.update(info)
+		return result
+
+	def benchmark_split(self, num_recipients, mix):
+		recipients = make_recipients(num_recipients, mix)
+		info = { "recipients": num_recipients, "mix": mix }
+		name = "%d %s" % (num_recipients, mix)
+
+		results = [
+			self.measure(name + " minimum", lambda : views.compute_minimum_contribution(recipients), **info),
+			self.measure(name + " maximum", lambda : views.compute_maximum_contribution(recipients), **info),
+			self.measure(name + " index", lambda : views.LineItemIndex(recipients), **info),
+		]
+
+		# Amounts from the minimum up to the maximum that the recipients can
+		# take (or the site maximum), spaced geometrically so that both small
+		# amounts and amounts where most recipients are at their limits are
+		# covered.
+		index = views.LineItemIndex(recipients)
+		low = views.compute_minimum_contribution(recipients, index)
+		high = min(views.compute_maximum_contribution(recipients, index), alg["max_contrib"])
+		amounts = geometric_amounts(low, high, 8)
+		for amount in amounts:
+			results.append(self.measure(
+				name + " line items $%s" % amount,
+				lambda : views.compute_line_items(recipients, amount, "12345", index),
+				amount=str(amount), **info))
+
+		# Without a precomputed index, as when the index isn't cached yet.
+		results.append(self.measure(
+			name + " line items, no index",
+			lambda : views.compute_line_items(recipients, amounts[len(amounts)//2], "12345"),
+			amount=str(amounts[len(amounts)//2]), **info))
+
+		return results
+
+	def benchmark_end_to_end(self):
+		# Run requests through the whole Django stack against a temporary
+		# Campaign, with Democracy Engine, email deliverability checks, and
+		# outgoing email kept local.
+		saved_de_api, saved_validate_email = views.DemocracyEngineAPI, views.validate_email
+		views.DemocracyEngineAPI = DummyDemocracyEngineAPIClient()
+		views.validate_email = lambda email : saved_validate_email(email, check_deliverability=False)
+		try:
+			with override_settings(
+				ALLOWED_HOSTS=['*'],
+				EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+				PAYMENT_QUEUE=None,
+				RECEIPT_OUTBOX=None):
+				with transaction.atomic():
+					results = self.run_end_to_end()
+					transaction.set_rollback(True)
+		finally:
+			views.DemocracyEngineAPI, views.validate_email = saved_de_api, saved_validate_email
+		return results
+
+	def run_end_to_end(self):
+		org = Organization.objects.create(name="Benchmark", slug="benchmark-org", extra={})
+		campaign = Campaign.objects.create(
+			owner=org, title="Benchmark", slug="benchmark", active=True,
+			headline="Benchmark", subhead="A *benchmark*.", body="A **benchmark** campaign.",
+			suggested_amount=Decimal("25"), recipients=make_recipients(20, "mixed"),
+			receipt_sender="Benchmark", receipt_subject="Receipt", receipt_template="Thanks for {{amount}}.",
+			extra={})
+		url = "/%s/%s" % (org.slug, campaign.slug)
+		client = Client()
+
+		# Each request gets a new rstate, like each visitor does, so that the
+		# previews are computed rather than served from the preview cache,
+		# unless the benchmark is of a cached preview.
+		rstates = itertools.count(1)
+		def post(data, rstate=None):
+			data = dict(data, rstate=rstate or str(next(rstates)))
+			data.setdefault("disabled-recipients", "")
+			response = client.post(url, data)
+			if response.status_code != 200 or json.loads(response.content.decode("utf8")).get("status") == "invalid":
+				raise CommandError("%s %s failed: %s" % (url, data.get("method"), response.content[:500]))
+
+		execute_fields = {
+			"method": "execute", "amount": "25.00",
+			"email": "benchmark@example.com", "nameFirst": "Benchmark", "nameLast": "Benchmark",
+			"phone": "202-555-1234", "address": "1 Main St", "city": "Washington", "state": "DC", "zip": "20001",
+			"occupation": "Tester", "employer": "None",
+			"ccNum": "4111111111111111", "ccExpMonth": "2", "ccExpYear": "2030", "ccCVV": "000",
+		}
+
+		def get_uncached():
+			# Render the page rather than using the copy kept in memory.
+			views.landing_page_cache.clear()
+			client.get(url)
+
+		info = { "recipients": len(campaign.recipients), "mix": "mixed" }
+		return [
+			self.measure("end-to-end GET form page", get_uncached, **info),
+			self.measure("end-to-end GET form page, cached", lambda : client.get(url), **info),
+			self.measure("end-to-end preview", lambda : post({ "amount": "25.00" }), **info),
+			self.measure("end-to-end preview, cached", lambda : post({ "amount": "25.00" }, rstate="12345"), **info),
+			self.measure("end-to-end preview, one disabled", lambda : post({ "amount": "25.00", "disabled-recipients": campaign.recipients[0]["id"] }), **info),
+			self.measure("end-to-end preview-batch", lambda : post({ "method": "preview-batch", "amounts": "10;25;50;100;250;500;1000;2500" }), **info),
+			self.measure("end-to-end execute", lambda : post(execute_fields), **info),
+		]
+
+	def compare(self, results, filename, threshold):
+		with open(filename) as f:
+			baseline = { result["name"]: result for result in json.load(f)["results"] }
+		regressions = []
+		for result in results:
+			if result["name"] in baseline:
+				ratio = result["median_us"] / baseline[result["name"]]["median_us"]
+				if ratio > threshold:
+					regressions.append("%s: %.1f us => %.1f us (%.2fx)" % (result["name"], baseline[result["name"]]["median_us"], result["median_us"], ratio))
+		if regressions:
+			raise CommandError("Benchmarks got slower:\n" + "\n".join(regressions))
+		print("No regressions compared to %s." % filename)
+
+def make_recipients(num_recipients, mix):
+	# Make a repeatable list of recipients. "candidates" are all candidates
+	# with a few different point values. "mixed" adds a PAC and a 501(c)(4)
+	# organization. "limit-heavy" has a few candidates with many more points
+	# than the rest so that they reach their limits at low amounts, which
+	# exercises the part of the split that fixes recipients at their limits.
+	rand = random.Random(num_recipients)
+	recipients = []
+	for i in range(num_recipients):
+		recipient = { "id": "R%d" % i, "name": "Recipient %d" % i, "de_recipient_id": "DE%d" % i, "type": "candidate" }
+		if mix == "limit-heavy":
+			recipient["points"] = 200 if i < max(1, num_recipients // 10) else rand.randint(1, 3)
+		else:
+			recipient["points"] = rand.randint(1, 4)
+		recipients.append(recipient)
+	if mix in ("mixed", "limit-heavy"):
+		recipients[-1] = { "id": recipients[-1]["id"], "name": "PAC", "de_recipient_id": "DEPAC", "type": "pac" }
+		recipients[-2] = { "id": recipients[-2]["id"], "name": "C4", "de_recipient_id": "DEC4", "type": "c4" }
+	return recipients
+
+def geometric_amounts(low, high, count):
+	amounts = []
+	for i in range(count):
+		amount = Decimal(float(low) * (float(high) / float(low)) ** (i / (count - 1)))
+		amount = min(max(views.round_to_cents(amount, views.ROUND_DOWN), low), high)
+		if amount not in amounts:
+			amounts.append(amount)
+	return amounts
@@ -0,0 +1,68 @@
+# Executes queued payments
+# ------------------------
+#
+# When the PAYMENT_QUEUE setting is on, the contribution form queues a
+# PaymentJob rather than calling Democracy Engine during the request.
+# This command runs those jobs.
+
+import sys
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from siteapp.models import PaymentJob
+from siteapp.views import run_payment_job, fail_payment_job, fail_abandoned_payment_jobs
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Executes queued payments.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--workers', type=int, help='The number of jobs to run at once. Defaults to the "workers" key of the PAYMENT_QUEUE setting, or 4.')
+		parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to wait before checking again when there are no jobs.')
+		parser.add_argument('--once', action='store_true', help='Exit when there are no more jobs ready to run.')
+
+	def handle(self, *args, **options):
+		workers = options['workers'] or (settings.PAYMENT_QUEUE or {}).get("workers", 4)
+		if workers < 1:
+			raise CommandError("There must be at least one worker.")
+
+		# Democracy Engine calls spend almost all of their time waiting
+		# on the network, so threads are enough to run jobs concurrently.
+		threads = [
+			threading.Thread(target=self.work, args=(options['poll_interval'], options['once']))
+			for _ in range(workers)
+		]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+	def work(self, poll_interval, once):
+		try:
+			while True:
+				job = PaymentJob.claim()
+				if job is None:
+					# While idle, clean up after workers that stopped
+					# partway through a job.
+					fail_abandoned_payment_jobs()
+					if once:
+						return
+					time.sleep(poll_interval)
+					continue
+
+				try:
+					run_payment_job(job)
+				except Exception as e:
+					# We can't tell whether the payment went through, so it
+					# must be sorted out by hand.
+					print("PaymentJob", job.id, "failed:", file=sys.stderr)
+					traceback.print_exc()
+					fail_payment_job(job, str(e))
+		finally:
+			# Each thread has its own database connection.
+			connection.close()
@@ -0,0 +1,77 @@
+# Executes queued voids
+# ---------------------
+#
+# The void action in the Contribution admin queues a VoidJob rather than
+# voiding each Contribution during the request, since each void makes
+# several slow Democracy Engine calls. This command runs those jobs.
+
+import concurrent.futures
+import sys
+import time
+import traceback
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils.timezone import now
+
+from siteapp.models import Contribution, VoidJob
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Executes queued voids.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--concurrency', type=int, default=8, help='The number of Contributions to void at once.')
+		parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to wait before checking again when there are no jobs.')
+		parser.add_argument('--once', action='store_true', help='Exit when there are no more jobs.')
+
+	def handle(self, *args, **options):
+		if options['concurrency'] < 1:
+			raise CommandError("--concurrency must be at least 1.")
+
+		while True:
+			job = VoidJob.claim()
+			if job is None:
+				if options['once']:
+					return
+				time.sleep(options['poll_interval'])
+				continue
+
+			try:
+				self.run_job(job, options['concurrency'])
+			except Exception:
+				# The job is left in the running state with the results so
+				# far, and another worker resumes it once its lease is up.
+				print("VoidJob", job.id, "failed:", file=sys.stderr)
+				traceback.print_exc()
+
+	def run_job(self, job, concurrency):
+		# Void the Contributions that haven't been tried yet in a bounded
+		# pool of threads, saving each result as soon as it comes back so
+		# that progress can be followed in the admin and so that if this
+		# worker stops, another worker resumes the job where it left off
+		# once VoidJob.LEASE has passed. Saving a result renews the lease.
+		with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+			futures = {
+				executor.submit(void_contribution, contribution_id): i
+				for i, (contribution_id, result) in enumerate(job.results)
+				if result is None
+			}
+			for future in concurrent.futures.as_completed(futures):
+				job.results[futures[future]][1] = future.result()
+				job.claimed_at = now()
+				job.save(update_fields=['results', 'claimed_at', 'updated'])
+
+		job.state = "finished"
+		job.save(update_fields=['state', 'updated'])
+
+def void_contribution(contribution_id):
+	# Returns the same strings as the admin action did when it voided
+	# Contributions during the request.
+	try:
+		return Contribution.objects.get(id=contribution_id).void()
+	except Exception as e:
+		return str(e)
+	finally:
+		# Each thread has its own database connection.
+		connection.close()
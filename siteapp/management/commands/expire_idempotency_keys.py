@@ -0,0 +1,31 @@
+# Deletes old idempotency keys
+# ----------------------------
+#
+# Each submission of the contribution form records its idempotency key
+# and response so that a resubmission isn't executed twice. They're only
+# needed while the form might be resubmitted, so this command deletes the
+# ones older than --max-age, including any whose first request died.
+
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from siteapp.models import IdempotencyKey
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Deletes idempotency keys for old contribution form submissions.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--max-age', type=float, default=24.0, help='Hours to keep each key.')
+		parser.add_argument('--poll-interval', type=float, default=60.0*60, help='Seconds to wait between deletions.')
+		parser.add_argument('--once', action='store_true', help='Delete once and exit.')
+
+	def handle(self, *args, **options):
+		while True:
+			IdempotencyKey.objects.filter(created__lt=now() - timedelta(hours=options['max_age'])).delete()
+			if options['once']:
+				return
+			time.sleep(options['poll_interval'])
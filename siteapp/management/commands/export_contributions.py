@@ -0,0 +1,44 @@
+# Exports contributions for compliance reporting
+# ----------------------------------------------
+#
+# Writes one row for each line item of each Contribution (each recipient
+# of each contribution) as CSV or JSON Lines, e.g.:
+#
+#   ./manage.py export_contributions --campaign 1 --format csv --output campaign1.csv
+#
+# Contributions are loaded a chunk at a time, so this runs in constant
+# memory however many contributions there are. See siteapp/export.py.
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from siteapp.models import Campaign, Contribution
+from siteapp.export import iter_contribution_rows, EXPORT_FORMATS
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Exports contributions with one row per line item as CSV or JSON Lines.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--campaign', type=int, action='append', help='The ID of a Campaign to export contributions for. Can be given more than once. Defaults to all Campaigns.')
+		parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv', help='The file format.')
+		parser.add_argument('--output', help='The file to write to. Defaults to standard output.')
+		parser.add_argument('--chunk-size', type=int, default=500, help='The number of contributions to load at a time.')
+
+	def handle(self, *args, **options):
+		contributions = Contribution.objects.all()
+		if options['campaign']:
+			missing = set(options['campaign']) - set(Campaign.objects.filter(id__in=options['campaign']).values_list('id', flat=True))
+			if missing:
+				raise CommandError("There is no Campaign with ID %s." % ", ".join(str(id) for id in sorted(missing)))
+			contributions = contributions.filter(campaign_id__in=options['campaign'])
+
+		iter_lines = EXPORT_FORMATS[options['format']][0]
+		lines = iter_lines(iter_contribution_rows(contributions, chunk_size=options['chunk_size']))
+
+		if options['output']:
+			with open(options['output'], 'w', newline='') as f:
+				f.writelines(lines)
+		else:
+			sys.stdout.writelines(lines)
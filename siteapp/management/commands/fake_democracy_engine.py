@@ -0,0 +1,226 @@
+# Runs a local stand-in for the Democracy Engine API
+# --------------------------------------------------
+#
+# For load testing (see the loadtest command) without touching the real
+# Democracy Engine. It serves the subscriber meta info with URLs that point
+# back at itself and answers the calls that DemocracyEngineAPIClient makes,
+# with configurable latency, errors, and hung requests. Point the app at it
+# with something like this in local/environment.json:
+#
+#   "democracyengine": {
+#     "api_baseurl": "http://127.0.0.1:8099",
+#     "account_number": "loadtest",
+#     "username": "loadtest",
+#     "password": "loadtest"
+#   }
+#
+# Donations are kept in memory only.
+
+import itertools
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Runs a local stand-in for the Democracy Engine API for load testing.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--host', default='127.0.0.1', help='The address to listen on.')
+		parser.add_argument('--port', type=int, default=8099, help='The port to listen on.')
+		parser.add_argument('--latency', type=float, default=0.5, help='The median response time in seconds.')
+		parser.add_argument('--latency-spread', type=float, default=0.5, help='How spread out response times are, as the sigma of a log-normal distribution. 0 makes every response take --latency.')
+		parser.add_argument('--error-rate', type=float, default=0.0, help='The fraction of requests that fail with HTTP 500.')
+		parser.add_argument('--validation-error-rate', type=float, default=0.0, help='The fraction of donations that are declined with a human-readable validation error.')
+		parser.add_argument('--timeout-rate', type=float, default=0.0, help='The fraction of requests that hang for --timeout-delay seconds before responding.')
+		parser.add_argument('--timeout-delay', type=float, default=65.0, help='How long hung requests take. The client gives up after 60 seconds, or 20 for live requests.')
+
+	def handle(self, *args, **options):
+		server = FakeDemocracyEngineServer((options['host'], options['port']), FakeDemocracyEngineHandler)
+		server.options = options
+		print("Fake Democracy Engine listening on http://%s:%d" % (options['host'], options['port']))
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+
+class FakeDemocracyEngineServer(socketserver.ThreadingMixIn, HTTPServer):
+	# One thread per connection so that slow responses don't hold up others.
+	daemon_threads = True
+
+	def __init__(self, *args, **kwargs):
+		super(FakeDemocracyEngineServer, self).__init__(*args, **kwargs)
+		self.donations = { }
+		self.transaction_status = { }
+		self.tokens = set()
+		self.lock = threading.Lock()
+		self.ids = itertools.count(1)
+
+class FakeDemocracyEngineHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1" # keep-alive, like the real API
+
+	# The API methods, by the name used in the meta info ("<name>_uri"),
+	# with their HTTP method and path after /subscribers/<account>.
+	routes = [
+		("recipients", "GET", "/recipients.json"),
+		("recipient", "GET", "/recipients/:recipient_id.json"),
+		("transactions", "GET", "/transactions.json"),
+		("transaction", "GET", "/transactions/:transaction_id.json"),
+		("transaction_void", "PUT", "/transactions/:transaction_id/void.json"),
+		("transaction_credit", "PUT", "/transactions/:transaction_id/credit.json"),
+		("donations", "GET", "/donations.json"),
+		("donation", "GET", "/donations/:donation_id.json"),
+		("donation_process", "POST", "/donations.json"),
+	]
+
+	def do_GET(self):
+		self.handle_api_request("GET")
+
+	def do_POST(self):
+		self.handle_api_request("POST")
+
+	def do_PUT(self):
+		self.handle_api_request("PUT")
+
+	def log_message(self, format, *args):
+		# Don't print a line for every request.
+		pass
+
+	def handle_api_request(self, http_method):
+		options = self.server.options
+		body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+		# Wait like the real API would.
+		if random.random() < options['timeout_rate']:
+			time.sleep(options['timeout_delay'])
+		elif options['latency'] > 0:
+			time.sleep(random.lognormvariate(0, options['latency_spread']) * options['latency'])
+
+		if random.random() < options['error_rate']:
+			return self.respond(500, { "error": "Simulated server error." })
+
+		# Query string parameters, like the start_date of the donations
+		# call, are ignored.
+		m = re.match(r"^/subscribers/([^/?]+)(/[^?]*)?(\?.*)?$", self.path)
+		if not m:
+			return self.respond(404, { "error": "Not found." })
+		account, path = m.group(1), m.group(2)
+
+		if path is None or path == ".json":
+			return self.respond(200, self.meta_info(account))
+
+		for name, method, pattern in self.routes:
+			m = re.match(route_regex(pattern), path)
+			if m and method == http_method:
+				return getattr(self, "api_" + name)(json.loads(body.decode("utf8")) if body else None, **m.groupdict())
+		return self.respond(404, { "error": "Not found." })
+
+	def respond(self, status, data):
+		body = json.dumps(data).encode("utf8") if data is not None else b""
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def meta_info(self, account):
+		base = "http://%s:%d/subscribers/%s" % (self.server.server_address[0], self.server.server_address[1], account)
+		return { name + "_uri": base + pattern for name, method, pattern in self.routes }
+
+	def api_recipients(self, data):
+		return self.respond(200, [])
+
+	def api_recipient(self, data, recipient_id):
+		return self.respond(200, { "recipient_id": recipient_id })
+
+	def api_transactions(self, data):
+		with self.server.lock:
+			transactions = [{ "transaction_guid": guid, "status": status } for guid, status in self.server.transaction_status.items()]
+		return self.respond(200, transactions)
+
+	def api_transaction(self, data, transaction_id):
+		with self.server.lock:
+			status = self.server.transaction_status.get(transaction_id)
+		if status is None:
+			return self.respond(404, { "error": "Not found." })
+		return self.respond(200, { "transaction_guid": transaction_id, "status": status })
+
+	def api_transaction_void(self, data, transaction_id):
+		return self.set_transaction_status(transaction_id, "voided")
+
+	def api_transaction_credit(self, data, transaction_id):
+		return self.set_transaction_status(transaction_id, "credited")
+
+	def set_transaction_status(self, transaction_id, status):
+		with self.server.lock:
+			if transaction_id not in self.server.transaction_status:
+				return self.respond(404, { "error": "Not found." })
+			self.server.transaction_status[transaction_id] = status
+		return self.respond(200, None)
+
+	def api_donations(self, data):
+		with self.server.lock:
+			donations = list(self.server.donations.values())
+		return self.respond(200, donations)
+
+	def api_donation(self, data, donation_id):
+		with self.server.lock:
+			donation = self.server.donations.get(donation_id)
+		if donation is None:
+			return self.respond(404, { "error": "Not found." })
+		return self.respond(200, donation)
+
+	def api_donation_process(self, data):
+		info = (data or { }).get("donation", { })
+		if random.random() < self.server.options['validation_error_rate']:
+			return self.respond(422, { "base": ["Card number is not a valid credit card number"] })
+
+		if info.get("token_request"):
+			# Exchange the card for a token that can be charged later.
+			with self.server.lock:
+				token = "K%d" % next(self.server.ids)
+				self.server.tokens.add(token)
+			return self.respond(200, { "token": token, "authtest_request": True })
+		if "token" in info and info["token"] not in self.server.tokens:
+			return self.respond(422, { "base": ["Invalid token"] })
+
+		with self.server.lock:
+			donation_id = "D%d" % next(self.server.ids)
+			transaction_guid = "T%d" % next(self.server.ids)
+			donation = {
+				"donation_id": donation_id,
+				"authtest_request": False,
+				"authcapture_request": True,
+				"aux_data": info.get("aux_data"),
+				"line_items": [
+					{
+						"recipient_id": line_item.get("recipient_id"),
+						"recipient_name": line_item.get("recipient_id"),
+						"amount": line_item.get("amount"),
+						"transaction_guid": transaction_guid,
+						"status": "captured",
+						"transaction_error": None,
+					}
+					for line_item in info.get("line_items", [])
+				],
+			}
+			for field in ("donor_first_name", "donor_last_name", "donor_address1", "donor_city", "donor_state", "donor_zip", "compliance_employer", "compliance_occupation"):
+				donation[field] = info.get(field)
+			self.server.donations[donation_id] = donation
+			self.server.transaction_status[transaction_guid] = "captured"
+		return self.respond(200, donation)
+
+def route_regex(pattern):
+	# Turn a path like /transactions/:transaction_id.json into a regex with
+	# a named group for each :argument.
+	parts = re.split(r":(\w+)", pattern)
+	return "^" + "".join(
+		re.escape(part) if i % 2 == 0 else "(?P<%s>[^/]+)" % part
+		for i, part in enumerate(parts)
+	) + "$"
@@ -0,0 +1,31 @@
+# Folds campaign counter shards into campaign totals
+# --------------------------------------------------
+#
+# New and voided Contributions record their changes to their Campaign's
+# totals in CampaignCounterShards so that checkouts don't wait on the
+# Campaign row. This command adds those changes into the Campaign rows,
+# so the stored totals are never more than --poll-interval seconds behind.
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from siteapp.models import CampaignCounterShard
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Folds campaign counter shards into the campaign totals.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--poll-interval', type=float, default=60.0, help='Seconds to wait between folds.')
+		parser.add_argument('--once', action='store_true', help='Fold once and exit.')
+
+	def handle(self, *args, **options):
+		while True:
+			campaign_ids = CampaignCounterShard.objects.exclude(contributors=0, contributions=0)\
+				.values_list('campaign_id', flat=True).distinct()
+			for campaign_id in list(campaign_ids):
+				CampaignCounterShard.fold(campaign_id)
+			if options['once']:
+				return
+			time.sleep(options['poll_interval'])
@@ -0,0 +1,208 @@
+# Load tests the site
+# -------------------
+#
+# Drives concurrent preview and execute traffic against a running copy of
+# the site and reports latency percentiles, throughput, and how busy the
+# uwsgi workers were, to help size the uwsgi pool. Everything runs on one
+# machine without network access:
+#
+# 1. Start the Democracy Engine stand-in:
+#      ./manage.py fake_democracy_engine --latency 0.8 --error-rate 0.01
+# 2. Point the site at it in local/environment.json (see that command).
+# 3. Run the site the way it runs in production, with the uwsgi stats
+#    server turned on, e.g.:
+#      uwsgi_python3 --http :8000 --wsgi-file siteapp/wsgi.py --processes 4 --stats 127.0.0.1:9191
+# 4. Run the load test against a campaign page:
+#      ./manage.py loadtest --url http://localhost:8000/org/campaign --ramp 1,2,4,8,16 --uwsgi-stats 127.0.0.1:9191
+#
+# Each simulated visitor loads the per-visitor info like the form page
+# does, previews a few amounts, and then executes a contribution with the
+# test card number with probability --execute-fraction. Executions create
+# real Contribution records, so use a development database.
+
+import json
+import random
+import socket
+import threading
+import time
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Drives concurrent preview and execute traffic against a running site and reports latency and throughput.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--url', required=True, help='The URL of a campaign page on the running site.')
+		parser.add_argument('--ramp', default='1,2,4,8,16', help='Comma-separated numbers of concurrent visitors to run, one step after another.')
+		parser.add_argument('--duration', type=float, default=30.0, help='Seconds to run each step.')
+		parser.add_argument('--execute-fraction', type=float, default=0.1, help='The fraction of visitors that go on to execute a contribution.')
+		parser.add_argument('--previews', type=int, default=3, help='The number of amounts each visitor previews.')
+		parser.add_argument('--timeout', type=float, default=90.0, help='Seconds to wait for each request.')
+		parser.add_argument('--uwsgi-stats', help='The host:port of the uwsgi stats server, to report how busy the workers were.')
+		parser.add_argument('--output', help='Save the results as JSON to this file.')
+
+	def handle(self, *args, **options):
+		try:
+			steps = [int(n) for n in options['ramp'].split(',')]
+		except ValueError:
+			raise CommandError("--ramp must be a comma-separated list of numbers.")
+
+		results = []
+		for concurrency in steps:
+			result = self.run_step(concurrency, options)
+			results.append(result)
+			self.print_step(result)
+
+		# The site is saturated once adding visitors stops adding throughput.
+		for prev, cur in zip(results, results[1:]):
+			if cur["throughput"] < prev["throughput"] * 1.1:
+				print("Throughput stopped growing at %d concurrent visitors (%.1f => %.1f requests/second)."
+					% (cur["concurrency"], prev["throughput"], cur["throughput"]))
+				break
+
+		if options['output']:
+			with open(options['output'], 'w') as f:
+				json.dump(results, f, indent=2, sort_keys=True)
+
+	def run_step(self, concurrency, options):
+		samples = [] # (request kind, seconds, ok)
+		samples_lock = threading.Lock()
+		deadline = time.time() + options['duration']
+
+		def record(kind, started, ok):
+			with samples_lock:
+				samples.append((kind, time.time() - started, ok))
+
+		def visitor_loop():
+			while time.time() < deadline:
+				try:
+					self.simulate_visitor(options, record)
+				except Exception:
+					# The failure has been recorded. Start over as a new visitor.
+					pass
+
+		# Sample the uwsgi workers' states while the step runs.
+		worker_samples = []
+		stop_sampling = threading.Event()
+		sampler = None
+		if options['uwsgi_stats']:
+			sampler = threading.Thread(target=sample_uwsgi_workers, args=(options['uwsgi_stats'], worker_samples, stop_sampling))
+			sampler.start()
+
+		started = time.time()
+		threads = [threading.Thread(target=visitor_loop) for _ in range(concurrency)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		elapsed = time.time() - started
+
+		if sampler:
+			stop_sampling.set()
+			sampler.join()
+
+		result = {
+			"concurrency": concurrency,
+			"seconds": elapsed,
+			"requests": len(samples),
+			"errors": sum(1 for s in samples if not s[2]),
+			"throughput": len(samples) / elapsed,
+			"latency": { },
+		}
+		for kind in sorted(set(s[0] for s in samples)):
+			times = sorted(s[1] for s in samples if s[0] == kind)
+			result["latency"][kind] = {
+				"count": len(times),
+				"errors": sum(1 for s in samples if s[0] == kind and not s[2]),
+				"p50": percentile(times, 50),
+				"p95": percentile(times, 95),
+				"p99": percentile(times, 99),
+			}
+		if worker_samples:
+			result["worker_busy_fraction"] = sum(worker_samples) / len(worker_samples)
+		return result
+
+	def simulate_visitor(self, options, record):
+		session = requests.Session()
+		timeout = options['timeout']
+
+		def request(kind, method, url, **kwargs):
+			started = time.time()
+			try:
+				response = session.request(method, url, timeout=timeout, **kwargs)
+				response.raise_for_status()
+				data = response.json()
+			except Exception:
+				record(kind, started, False)
+				raise
+			record(kind, started, data.get("status") not in ("invalid", "error"))
+			return data
+
+		# The per-visitor values, which also set the CSRF cookie.
+		base_url = options['url'].split('/', 3)
+		base_url = "/".join(base_url[:3])
+		info = request("visitor-info", "GET", base_url + "/visitor-info")
+		post_headers = { "X-CSRFToken": info["csrf_token"], "Referer": options['url'] }
+		form = { "rstate": info["rstate"], "disabled-recipients": "" }
+
+		# Previews.
+		for _ in range(options['previews']):
+			amount = random.choice(["5.00", "10.00", "25.00", "50.00", "100.00", "250.00"])
+			request("preview", "POST", options['url'], data=dict(form, amount=amount), headers=post_headers)
+
+		if random.random() >= options['execute_fraction']:
+			return
+
+		# Execute with the test card number.
+		contributor = info["random_user_info"]
+		data = dict(form,
+			method="execute", amount=amount, email="loadtest@example.com",
+			ccNum="4111111111111111", ccExpMonth="2", ccExpYear=str(time.gmtime().tm_year + 2), ccCVV="000",
+			**{ k: str(contributor.get(k, "x")) for k in ("nameFirst", "nameLast", "phone", "address", "city", "state", "zip", "occupation", "employer") })
+		started = time.time()
+		result = request("execute", "POST", options['url'], data=data, headers=post_headers)
+
+		# If the payment queue is on, wait for the result like the page does.
+		if result.get("status") == "queued":
+			while True:
+				time.sleep(1)
+				status = session.get(base_url + "/payment/" + result["job"], timeout=timeout).json()
+				if status.get("status") != "queued":
+					record("execute (queued, until finished)", started, status.get("status") == "ok")
+					break
+
+	def print_step(self, result):
+		print("%d concurrent visitors: %d requests in %.1fs, %.1f requests/second, %d errors"
+			% (result["concurrency"], result["requests"], result["seconds"], result["throughput"], result["errors"]))
+		for kind, latency in result["latency"].items():
+			print("  %-35s n=%-6d p50=%6.0fms p95=%6.0fms p99=%6.0fms errors=%d"
+				% (kind, latency["count"], latency["p50"]*1000, latency["p95"]*1000, latency["p99"]*1000, latency["errors"]))
+		if "worker_busy_fraction" in result:
+			print("  uwsgi workers busy: %.0f%%" % (result["worker_busy_fraction"]*100))
+
+def percentile(sorted_values, p):
+	# Nearest-rank percentile.
+	if not sorted_values:
+		return 0.0
+	k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + .5)) - 1))
+	return sorted_values[k]
+
+def sample_uwsgi_workers(hostport, samples, stop):
+	# The uwsgi stats server sends a JSON document and closes the connection
+	# on each connect. Record the fraction of workers that are busy.
+	host, port = hostport.rsplit(":", 1)
+	while not stop.wait(0.25):
+		try:
+			with socket.create_connection((host, int(port)), timeout=2) as s:
+				data = b""
+				while True:
+					chunk = s.recv(65536)
+					if not chunk:
+						break
+					data += chunk
+			workers = json.loads(data.decode("utf8"))["workers"]
+			samples.append(sum(1 for w in workers if w.get("status") == "busy") / float(len(workers)))
+		except (OSError, ValueError, KeyError, ZeroDivisionError):
+			pass
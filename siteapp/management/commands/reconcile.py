@@ -1,33 +1,201 @@
 # Reconciles our records with Democracy Engine
 # --------------------------------------------
+#
+# Each run picks up from a ReconcileCheckpoint: the last Contribution such
+# that it and every earlier Contribution were reconciled without issues.
+# Only the donations made since that Contribution are fetched from
+# Democracy Engine, and only later Contributions are checked against them.
+# The checkpoint then moves up to just before the first Contribution that
+# still has issues (or isn't on Democracy Engine yet), so those are checked
+# again on the next run. Use --full to check everything again.
+#
+# When a Contribution matches its donation record, a fingerprint of the
+# record is saved on the Contribution, so that on later runs the donation
+# can be skipped without loading the Contribution if the record hasn't
+# changed.
+#
+# Contributions before the checkpoint can still change when they are
+# voided, which clears their fingerprint. A second pass fetches the
+# donation record of each of those again. Voids and credits made on
+# Democracy Engine directly don't change our records, so use --full or
+# --verify-transactions to find those.
+#
+# The donations list only has the status Democracy Engine recorded with
+# each line item. With --verify-transactions, the actual status of each
+# transaction is fetched too, several at a time since each call spends
+# most of its time waiting on Democracy Engine.
 
+import concurrent.futures
+from datetime import timedelta
 from decimal import Decimal
+import hashlib
 import io
+import json
 
 from django.core.management.base import BaseCommand, CommandError
 
 from siteapp.views import DemocracyEngineAPI
-from siteapp.models import Contribution
+from siteapp.models import Contribution, ReconcileCheckpoint
 
 class Command(BaseCommand):
 	args = ''
 	help = 'Reports reconciliation issues between our records and Democracy Engine.'
 
+	chunk_size = 500
+
+	def add_arguments(self, parser):
+		parser.add_argument('--full', action='store_true', help='Check all donations, including ones that were reconciled without issues before and have not changed since.')
+		parser.add_argument('--verify-transactions', action='store_true', help='Also fetch each transaction from Democracy Engine to check its void/credit status.')
+		parser.add_argument('--concurrency', type=int, default=8, help='The number of transactions to fetch at once with --verify-transactions.')
+
 	def handle(self, *args, **options):
-		# Get recent donations from DE.
-		donations = DemocracyEngineAPI.donations()
+		# Check the options before spending time on Democracy Engine calls.
+		if options.get('concurrency', 1) < 1:
+			raise CommandError("--concurrency must be at least 1.")
+
+		checkpoint = ReconcileCheckpoint.objects.first() or ReconcileCheckpoint()
+		incremental = not options['full'] and checkpoint.contribution_created is not None
+		if not incremental:
+			start_id = 0
+			donations = DemocracyEngineAPI.donations()
+		else:
+			# Fetch the donations made since the checkpoint, with a day to
+			# spare in case Democracy Engine's dates are in another time zone.
+			# Democracy Engine may also return older ones, so filter too.
+			start_id = checkpoint.contribution_id
+			donations = DemocracyEngineAPI.donations(start_date=(checkpoint.contribution_created - timedelta(days=1)).date())
+			donations = [don for don in donations if (get_contribution_id(don) or start_id + 1) > start_id]
 
-		# Process each donation that Democracy Engine knows.
+		# Process each donation that Democracy Engine knows, a chunk at a
+		# time so that the Contributions can be loaded in bulk.
 		seen_contributions = set()
-		for don in donations:
-			self.process_de_donation(don, seen_contributions)
+		transactions = []
+		for i in range(0, len(donations), self.chunk_size):
+			chunk = donations[i:i+self.chunk_size]
+			contribution_ids = set(filter(None, (get_contribution_id(don) for don in chunk)))
+
+			if options.get('verify_transactions'):
+				for don in chunk:
+					if get_contribution_id(don) and don["authcapture_request"] and not don["authtest_request"]:
+						for txn_guid in sorted(set(line_item["transaction_guid"] for line_item in don["line_items"])):
+							transactions.append((txn_guid, get_contribution_id(don)))
+
+			# Skip the donations whose fingerprint hasn't changed, which only
+			# needs the fingerprints.
+			if not options['full']:
+				fingerprints = dict(Contribution.objects.filter(id__in=contribution_ids).values_list('id', 'reconciled_fingerprint'))
+				changed = []
+				for don in chunk:
+					if get_contribution_id(don) in fingerprints and fingerprints[get_contribution_id(don)] == compute_fingerprint(don):
+						seen_contributions.add(get_contribution_id(don))
+					else:
+						changed.append(don)
+				chunk = changed
+				contribution_ids = set(filter(None, (get_contribution_id(don) for don in chunk)))
+
+			# Load the rest of the Contributions in bulk, with just the fields
+			# that are checked, and check them.
+			contributions = Contribution.objects.only(*CHECKED_FIELDS).in_bulk(contribution_ids)
+			for don in chunk:
+				self.reconcile_donation(don, seen_contributions, contributions)
+
+		# Anything missing from Democray Engine? Contributions that were
+		# reconciled before are known to be on Democracy Engine, so only the
+		# ones that haven't been need to be checked. Without a checkpoint,
+		# Democracy Engine only returns recent donations, so only check
+		# Contributions from the first one it returned.
+		if not incremental:
+			start_id = min(seen_contributions) if (len(seen_contributions) > 0) else 0
+		for id in Contribution.objects.filter(id__gt=start_id, reconciled_fingerprint=None)\
+			.order_by('id').values_list('id', flat=True).iterator():
+			if id not in seen_contributions:
+				print("Contribution", id, "has no donation record on Democracy Engine.")
+
+		# Check the Contributions before the checkpoint that have changed
+		# since they were reconciled (or that were before the donations
+		# Democracy Engine returned when there was no checkpoint yet).
+		if incremental:
+			for c in Contribution.objects.filter(id__lte=start_id, reconciled_fingerprint=None).only(*CHECKED_FIELDS).order_by('id').iterator():
+				self.recheck_contribution(c)
+
+		self.update_checkpoint(checkpoint, start_id)
+
+		if options.get('verify_transactions'):
+			self.verify_transactions(transactions, options['concurrency'])
+
+	def reconcile_donation(self, don, seen_contributions, contributions):
+		self.has_issues = False
+		c = self.process_de_donation(don, seen_contributions, contributions)
+		if c and not self.has_issues:
+			# Remember that this Contribution is reconciled.
+			Contribution.objects.filter(id=c.id).update(reconciled_fingerprint=compute_fingerprint(don))
 
-		# Anything missing from Democray Engine?
-		first_contrib_id = min(seen_contributions) if (len(seen_contributions) > 0) else 0
-		for c in Contribution.objects.filter(id__gt=first_contrib_id).exclude(id__in=seen_contributions):
+	def recheck_contribution(self, c):
+		# Fetch the donation record of a Contribution again and check it.
+		donation_id = (c.transaction or { }).get("donation_id")
+		if not donation_id:
 			print("Contribution", c.id, "has no donation record on Democracy Engine.")
+			return
+		try:
+			don = DemocracyEngineAPI.get_donation(donation_id)
+		except Exception as e:
+			print("Donation", donation_id, "/", c.id, "could not be retrieved:", e)
+			return
+		self.reconcile_donation(don, set(), { c.id: c })
+
+	def update_checkpoint(self, checkpoint, start_id):
+		# Move the checkpoint to just before the first Contribution after
+		# start_id that hasn't been reconciled.
+		contributions = Contribution.objects.all()
+		first_unreconciled = Contribution.objects.filter(id__gt=start_id, reconciled_fingerprint=None).order_by('id').values_list('id', flat=True).first()
+		if first_unreconciled is not None:
+			contributions = contributions.filter(id__lt=first_unreconciled)
+		last = contributions.only('id', 'created').order_by('-id').first()
+		if last is None:
+			return
+		checkpoint.contribution_id = last.id
+		checkpoint.contribution_created = last.created
+		checkpoint.save()
+
+	def verify_transactions(self, transactions, concurrency):
+		# Load whether each Contribution was voided. This is done up front
+		# so that the worker threads only make Democracy Engine calls.
+		voided = { }
+		contribution_ids = sorted(set(contribution_id for txn_guid, contribution_id in transactions))
+		for i in range(0, len(contribution_ids), self.chunk_size):
+			for c in Contribution.objects.only('id', 'extra').filter(id__in=contribution_ids[i:i+self.chunk_size]):
+				voided[c.id] = bool(c.extra and c.extra.get("void"))
+
+		# Fetch the transactions in a bounded pool of threads and report on
+		# each as soon as it comes back.
+		with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+			futures = {
+				executor.submit(DemocracyEngineAPI.get_transaction, txn_guid): (txn_guid, contribution_id)
+				for txn_guid, contribution_id in transactions
+				if contribution_id in voided
+			}
+			for future in concurrent.futures.as_completed(futures):
+				txn_guid, contribution_id = futures[future]
+				try:
+					txn = future.result()
+				except Exception as e:
+					print("Transaction", txn_guid, "/", contribution_id, "could not be retrieved:", e)
+					continue
 
-	def process_de_donation(self, don, seen_contributions):
+				if txn['status'] in ("authorized", "captured"):
+					if voided[contribution_id]:
+						print("Transaction", txn_guid, "/", contribution_id, "has status %s but should be voided/credited." % txn['status'])
+				elif txn['status'] in ("voided", "credited"):
+					if not voided[contribution_id]:
+						print("Transaction", txn_guid, "/", contribution_id, "has unexpected status %s." % txn['status'])
+				else:
+					print("Transaction", txn_guid, "/", contribution_id, "has unexpected status %s." % txn['status'])
+
+	def report(self, *args):
+		self.has_issues = True
+		print(*args)
+
+	def process_de_donation(self, don, seen_contributions, contributions):
 		if don["authtest_request"]:
 			# This was an authorization test. There's no need to
 			# reconcile these. We don't do this on this site.
@@ -43,29 +211,29 @@ class Command(BaseCommand):
 		# Sanity checks.
 
 		if not don["authcapture_request"]:
-			print(don["donation_id"], "has authtest_request, authcapture_request both False")
+			self.report(don["donation_id"], "has authtest_request, authcapture_request both False")
 			return
 
 		if len(don["line_items"]) == 0:
-			print(don["donation_id"], "has no line items")
+			self.report(don["donation_id"], "has no line items")
 			return
 
 		txns = set()
 		for line_item in don["line_items"]:
 			txns.add(line_item["transaction_guid"])
 		if len(txns) != 1:
-			print(don["donation_id"], "has more than one transaction (should be one)")
+			self.report(don["donation_id"], "has more than one transaction (should be one)")
 			return
 
 		if not isinstance(don["aux_data"], dict):
-			print(don["donation_id"], "has invalid aux_data")
+			self.report(don["donation_id"], "has invalid aux_data")
 			return
 		
 		# What pledge does this correspond to?
-		contribution_id = int(don["aux_data"]["contribution"])
-		c = Contribution.objects.filter(id=contribution_id).first()
+		contribution_id = get_contribution_id(don)
+		c = contributions.get(contribution_id)
 		if not c:
-			print(don["donation_id"], "has invalid contribution ID")
+			self.report(don["donation_id"], "has invalid contribution ID")
 			print(don)
 			return
 
@@ -84,7 +252,7 @@ class Command(BaseCommand):
 			("compliance_occupation", "occupation"),
 		]:
 			if don.get(de_field) != c.contributor.get(contrib_field):
-				print(don["donation_id"], "/", c.id, "has a mismatch in %s (%s, %s)" % (de_field, repr(don.get(de_field)), repr(c.contributor.get(contrib_field))))
+				self.report(don["donation_id"], "/", c.id, "has a mismatch in %s (%s, %s)" % (de_field, repr(don.get(de_field)), repr(c.contributor.get(contrib_field))))
 
 		# Check recipients.
 		recips = { r[0]["de_recipient_id"]: parse_decimal(r[1]) for r in c.recipients }
@@ -93,14 +261,14 @@ class Command(BaseCommand):
 			actual = parse_decimal(line_item["amount"].replace("$", ""))
 			expected = recips.get(line_item["recipient_id"], Decimal(0))
 			if actual != expected:
-				print(don["donation_id"], "/", c.id, "has recipient mismatch %s got %s instead of %s"
+				self.report(don["donation_id"], "/", c.id, "has recipient mismatch %s got %s instead of %s"
 					% (line_item["recipient_name"], actual, expected))
 			if line_item["recipient_id"] in recips:
 				del recips[line_item["recipient_id"]]
 
 		# Anything orphaned?
 		for r, expected in recips.items():
-			print(don["donation_id"], "/", c.id, "has recipient mismatch %s got %s instead of %s"
+			self.report(don["donation_id"], "/", c.id, "has recipient mismatch %s got %s instead of %s"
 				% (r, Decimal(0), expected))
 
 		# Check transaction info on the first line item.
@@ -108,18 +276,38 @@ class Command(BaseCommand):
 
 		# Any transaction error?
 		if line_item["transaction_error"]:
-			print(don["donation_id"], "/", c.id, "has a transaction error:", line_item["transaction_error"])
+			self.report(don["donation_id"], "/", c.id, "has a transaction error:", line_item["transaction_error"])
 
 		# Void/credit status.
 		if line_item["status"] == "captured":
 			if c.extra and c.extra.get("void"):
-				print(don["donation_id"], "/", c.id, "has status %s but should be voided/credited." % line_item["status"])
+				self.report(don["donation_id"], "/", c.id, "has status %s but should be voided/credited." % line_item["status"])
 		elif line_item["status"] in ("voided", "credited"):
 			if not (c.extra and c.extra.get("void")):
-				print(don["donation_id"], "/", c.id, "has unexpected status %s." % line_item["status"])
+				self.report(don["donation_id"], "/", c.id, "has unexpected status %s." % line_item["status"])
 		else:
-			print(don["donation_id"], "/", c.id, "has unexpected status %s." % line_item["status"])
+			self.report(don["donation_id"], "/", c.id, "has unexpected status %s." % line_item["status"])
+
+		return c
 
 def parse_decimal(s):
 	# Parse and round to cents, because conversion from floats is inexact.
 	return Decimal(s).quantize(Decimal('.01'))
+
+def get_contribution_id(don):
+	# Get the ID of the Contribution that a donation corresponds to, or None.
+	try:
+		return int(don["aux_data"]["contribution"])
+	except (TypeError, KeyError, ValueError):
+		return None
+
+# The Contribution fields that process_de_donation compares with the
+# donation record, plus the transaction for recheck_contribution.
+CHECKED_FIELDS = ['id', 'contributor', 'recipients', 'amount', 'transaction', 'extra']
+
+def compute_fingerprint(don):
+	# Changes to the donation record change the fingerprint. Changes to the
+	# Contribution that matter, i.e. voids, clear the fingerprint instead,
+	# so that the Contribution doesn't have to be loaded to check.
+	data = json.dumps(don, sort_keys=True, default=str)
+	return hashlib.sha1(data.encode("utf8")).hexdigest()
@@ -0,0 +1,70 @@
+# Sends queued receipt emails
+# ---------------------------
+#
+# When the RECEIPT_OUTBOX setting is on, receipts for new contributions
+# are queued as OutgoingReceipts rather than sent during the request.
+# This command sends them in batches, each over a single connection to
+# the mail server. Run only one instance at a time.
+
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from siteapp.models import OutgoingReceipt
+from siteapp.views import send_outgoing_receipt
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Sends queued receipt emails.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--poll-interval', type=float, default=5.0, help='Seconds to wait before checking again when there are no receipts to send.')
+		parser.add_argument('--once', action='store_true', help='Exit when there are no more receipts ready to send.')
+
+	def handle(self, *args, **options):
+		outbox_settings = settings.RECEIPT_OUTBOX or { }
+		batch_size = outbox_settings.get("batch_size", 100)
+		max_attempts = outbox_settings.get("max_attempts", 5)
+
+		while True:
+			# Get the next batch of receipts ready to send. Receipts that
+			# have failed too many times are left for an admin to look at.
+			batch = list(OutgoingReceipt.objects
+				.filter(send_after__lte=now(), attempts__lt=max_attempts)
+				.select_related('contribution', 'contribution__campaign')
+				.order_by('send_after')
+				[0:batch_size])
+			if len(batch) == 0:
+				if options['once']:
+					return
+				time.sleep(options['poll_interval'])
+				continue
+
+			# Send them all over one connection.
+			sent = 0
+			connection = get_connection()
+			open_connection(connection)
+			try:
+				for outgoing_receipt in batch:
+					if send_outgoing_receipt(outgoing_receipt, connection):
+						sent += 1
+					else:
+						# The connection may be broken. Start a new one.
+						connection.close()
+						open_connection(connection)
+			finally:
+				connection.close()
+
+			print("Sent", sent, "of", len(batch), "receipts.")
+
+def open_connection(connection):
+	# If the mail server can't be reached, leave the connection closed.
+	# Each message will then try to open its own connection, and failures
+	# will be recorded on the receipts so that they are retried later.
+	try:
+		connection.open()
+	except Exception:
+		pass
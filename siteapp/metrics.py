@@ -0,0 +1,130 @@
+# In-process metrics, exposed in the Prometheus text format by metrics_view.
+#
+# Each worker process keeps its own counts, so a scraper sees one process
+# per scrape. Recording a value takes a lock and a few dictionary updates,
+# which is negligible next to a request.
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from django.http import HttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.utils.deprecation import MiddlewareMixin
+
+# Histogram bucket upper bounds, in seconds.
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+registry = { }
+registry_lock = threading.Lock()
+
+class Metric(object):
+  def __init__(self, name, help):
+    self.name = name
+    self.help = help
+    self.values = { } # label tuples => values
+    self.lock = threading.Lock()
+    with registry_lock:
+      registry[name] = self
+
+class Counter(Metric):
+  type = "counter"
+
+  def inc(self, amount=1, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def render(self):
+    with self.lock:
+      values = list(self.values.items())
+    for labels, value in sorted(values):
+      yield "%s%s %s" % (self.name, format_labels(labels), format_value(value))
+
+class Histogram(Metric):
+  type = "histogram"
+
+  def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+    super(Histogram, self).__init__(name, help)
+    self.buckets = buckets
+
+  def observe(self, value, **labels):
+    key = tuple(sorted(labels.items()))
+    i = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      counts = self.values.get(key)
+      if counts is None:
+        # Per-bucket counts (the last is for values above every bucket), then the sum.
+        counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+      counts[i] += 1
+      counts[-1] += value
+
+  def render(self):
+    with self.lock:
+      values = [(labels, list(counts)) for labels, counts in self.values.items()]
+    for labels, counts in sorted(values):
+      cumulative = 0
+      for bound, count in zip(self.buckets + (float("inf"),), counts):
+        cumulative += count
+        yield "%s_bucket%s %d" % (self.name, format_labels(labels + (("le", format_value(bound)),)), cumulative)
+      yield "%s_sum%s %s" % (self.name, format_labels(labels), format_value(counts[-1]))
+      yield "%s_count%s %d" % (self.name, format_labels(labels), cumulative)
+
+def format_labels(labels):
+  if not labels:
+    return ""
+  return "{" + ",".join(
+    '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+    for k, v in labels) + "}"
+
+def format_value(value):
+  if value == float("inf"):
+    return "+Inf"
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render_all():
+  with registry_lock:
+    metrics = sorted(registry.values(), key=lambda m : m.name)
+  lines = []
+  for metric in metrics:
+    lines.append("# HELP %s %s" % (metric.name, metric.help))
+    lines.append("# TYPE %s %s" % (metric.name, metric.type))
+    lines.extend(metric.render())
+  return "\n".join(lines) + "\n"
+
+# REQUEST TIMING
+
+request_seconds = Histogram("newco_request_seconds", "Time to handle a request, by view and HTTP method.")
+phase_seconds = Histogram("newco_phase_seconds", "Time spent in each phase of handling a request, by view.")
+
+# The view of the request being handled on this thread, for labeling phases.
+current = threading.local()
+
+@contextmanager
+def timed(phase):
+  # Record the time spent in a phase, such as a database write or a call
+  # to Democracy Engine.
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    phase_seconds.observe(time.perf_counter() - start, phase=phase, view=getattr(current, "view", "none"))
+
+class RequestTimingMiddleware(MiddlewareMixin):
+  def process_request(self, request):
+    request._timing_start = time.perf_counter()
+    current.view = "none"
+
+  def process_view(self, request, view_func, view_args, view_kwargs):
+    current.view = getattr(view_func, "__name__", "unknown")
+
+  def process_response(self, request, response):
+    if hasattr(request, "_timing_start"):
+      request_seconds.observe(time.perf_counter() - request._timing_start, view=current.view, method=request.method)
+      current.view = "none"
+    return response
+
+@staff_member_required
+def metrics_view(request):
+  return HttpResponse(render_all(), content_type="text/plain; version=0.0.4")
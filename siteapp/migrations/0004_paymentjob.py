@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0003_auto_20161019_1909'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='A random identifier for this job given to the user so that they can check its status.', max_length=32, unique=True)),
+                ('payment', jsonfield.fields.JSONField(blank=True, help_text="A Democracy Engine token for the contributor's card, never the card itself. Cleared as soon as the job is finished.")),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('finished', 'Finished')], db_index=True, default='queued', help_text='Whether this job is waiting for a worker, being run by a worker, or finished.', max_length=12)),
+                ('attempts', models.IntegerField(default=0, help_text='The number of times a worker has started this job.')),
+                ('run_after', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text="Workers won't start this job before this time, so that retries back off.")),
+                ('result', jsonfield.fields.JSONField(blank=True, help_text='Once the job is finished, the response to give the user.')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated', models.DateTimeField(auto_now=True, db_index=True)),
+                ('contribution', models.OneToOneField(blank=True, help_text='The Contribution to execute. Cleared if the Contribution is deleted because the payment failed validation.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payment_job', to='siteapp.Contribution')),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0004_paymentjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingReceipt',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attempts', models.IntegerField(default=0, help_text='The number of times sending this receipt has failed.')),
+                ('last_error', models.TextField(blank=True, help_text='The error from the last failed attempt to send this receipt.')),
+                ('send_after', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text="The receipt won't be sent before this time, so that retries back off.")),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('contribution', models.OneToOneField(help_text='The Contribution to send a receipt for.', on_delete=django.db.models.deletion.CASCADE, related_name='outgoing_receipt', to='siteapp.Contribution')),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0005_outgoingreceipt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contribution',
+            name='reconciled_fingerprint',
+            field=models.CharField(blank=True, db_index=True, help_text='Set by the reconcile management command when this Contribution last matched its Democracy Engine donation record, so that it can be skipped until either changes. If empty, it has not yet been reconciled without issues.', max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0006_contribution_reconciled_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoidJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('results', jsonfield.fields.JSONField(help_text='A list of [contribution ID, result] pairs, one for each Contribution to void. The result is null until the void has been attempted, and then it is the status text returned by Contribution.void() or the error that it raised.')),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('finished', 'Finished')], db_index=True, default='queued', help_text='Whether this job is waiting for a worker, being run by a worker, or finished.', max_length=12)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+    ]
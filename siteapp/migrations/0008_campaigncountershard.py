@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0007_voidjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CampaignCounterShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.IntegerField(help_text="Which of the Campaign's shards this is.")),
+                ('contributors', models.IntegerField(default=0, help_text="The change to the Campaign's total_contributors.")),
+                ('contributions', models.DecimalField(decimal_places=2, default=0, help_text="The change to the Campaign's total_contributions.", max_digits=10)),
+                ('campaign', models.ForeignKey(help_text='The Campaign whose totals these are changes to.', on_delete=django.db.models.deletion.CASCADE, related_name='counter_shards', to='siteapp.Campaign')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='campaigncountershard',
+            unique_together=set([('campaign', 'shard')]),
+        ),
+        migrations.AlterField(
+            model_name='campaign',
+            name='total_contributions',
+            field=models.DecimalField(decimal_places=2, default=0, help_text='A running total of contributions made through this Campaign, as of the last time the counter shards were folded in.', max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='campaign',
+            name='total_contributors',
+            field=models.IntegerField(default=0, help_text='A running total of the number of individuals who made a contribution through this Campaign, as of the last time the counter shards were folded in.'),
+        ),
+    ]
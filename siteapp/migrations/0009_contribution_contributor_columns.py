@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0008_campaigncountershard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contribution',
+            name='contributor_email',
+            field=models.CharField(blank=True, db_index=True, help_text="The contributor's email address, lowercased.", max_length=254, null=True),
+        ),
+        migrations.AddField(
+            model_name='contribution',
+            name='contributor_name',
+            field=models.CharField(blank=True, db_index=True, help_text="The contributor's first and last name, lowercased.", max_length=200, null=True),
+        ),
+        migrations.AddField(
+            model_name='contribution',
+            name='contributor_state',
+            field=models.CharField(blank=True, db_index=True, help_text="The contributor's state, uppercased.", max_length=2, null=True),
+        ),
+        migrations.AddField(
+            model_name='contribution',
+            name='contributor_zip',
+            field=models.CharField(blank=True, db_index=True, help_text="The contributor's ZIP code.", max_length=10, null=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_status(apps, schema_editor):
+    # A copy of Contribution.compute_status, since migrations use historical
+    # models without their methods.
+    Contribution = apps.get_model('siteapp', 'Contribution')
+    last_id = 0
+    while True:
+        batch = list(Contribution.objects.only('id', 'transaction', 'extra').filter(id__gt=last_id).order_by('id')[0:1000])
+        if len(batch) == 0:
+            break
+        for c in batch:
+            if c.extra and c.extra.get("void"):
+                status = "voided" if all(v.get("method") for v in c.extra["void"]) else "void-error"
+            elif not c.transaction:
+                status = "pending"
+            elif c.transaction.get("error"):
+                status = "error"
+            elif c.extra and c.extra.get("error_sending_receipt"):
+                status = "receipt-error"
+            else:
+                status = "ok"
+            if status != "pending":
+                Contribution.objects.filter(id=c.id).update(status=status)
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0009_contribution_contributor_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contribution',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ok', 'OK'), ('error', 'Transaction Error'), ('receipt-error', 'Receipt Email Error'), ('voided', 'Voided'), ('void-error', 'Void Error')], db_index=True, default='pending', help_text='A summary of transaction and extra, set on save, for listing and filtering Contributions.', max_length=16),
+        ),
+        migrations.RunPython(set_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0010_contribution_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='The random key that the contribution form sent with the submission.', max_length=64, unique=True)),
+                ('response', jsonfield.fields.JSONField(blank=True, help_text='The response to the first submission with this key, or null while it is being processed.', null=True)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('campaign', models.ForeignKey(help_text='The Campaign whose form was submitted.', on_delete=django.db.models.deletion.CASCADE, to='siteapp.Campaign')),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0011_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentjob',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When a worker last started this job. A job that has been running for too long is assumed to have been abandoned by a worker that stopped.', null=True),
+        ),
+    ]
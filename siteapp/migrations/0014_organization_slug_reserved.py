@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import siteapp.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0013_paymentjob_claimed_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='organization',
+            name='slug',
+            field=models.SlugField(help_text='The unique URL slug for this Organization.', max_length=200, validators=[siteapp.models.validate_organization_slug]),
+        ),
+    ]
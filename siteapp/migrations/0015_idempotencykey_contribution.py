@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0014_organization_slug_reserved'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='contribution',
+            field=models.ForeignKey(blank=True, help_text='The Contribution created by the first submission with this key, set before it is executed.', null=True, on_delete=django.db.models.deletion.SET_NULL, to='siteapp.Contribution'),
+        ),
+    ]
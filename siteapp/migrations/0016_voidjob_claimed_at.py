@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0015_idempotencykey_contribution'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='voidjob',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text="When a worker started this job or last saved a result. A running job whose worker hasn't done either for too long is assumed to have been abandoned and is resumed by another worker.", null=True),
+        ),
+    ]
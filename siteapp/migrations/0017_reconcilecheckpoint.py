@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0016_voidjob_claimed_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconcileCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contribution_id', models.IntegerField(default=0, help_text='The ID of a Contribution such that it and every earlier Contribution have been reconciled without issues.')),
+                ('contribution_created', models.DateTimeField(blank=True, help_text='When that Contribution was created. Donations are fetched from Democracy Engine starting from this date.', null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0017_reconcilecheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contribution',
+            name='contributor_last_name',
+            field=models.CharField(blank=True, db_index=True, help_text="The contributor's last name, lowercased, so that it can be searched on its own.", max_length=200, null=True),
+        ),
+    ]
@@ -1,8 +1,11 @@
+from django.core.exceptions import ValidationError
 from django.db import models, transaction
 from django.utils.timezone import now
 
 from jsonfield import JSONField
 
+from .metrics import timed
+
 import decimal
 
 alg = {
@@ -15,11 +18,19 @@ alg = {
   }
 }
 
+# Campaign URLs are /<organization slug>/<campaign slug>, so an Organization
+# can't have the slug of a path that siteapp.urls routes elsewhere.
+RESERVED_ORGANIZATION_SLUGS = {"admin", "metrics", "payment", "static", "test-error-email", "visitor-info"}
+
+def validate_organization_slug(value):
+  if value.lower() in RESERVED_ORGANIZATION_SLUGS:
+    raise ValidationError("'%s' is used by another page on the site and can't be an Organization's slug." % value)
+
 class Organization(models.Model):
   """An organization is a Newco client."""
 
   name = models.CharField(max_length=200, help_text="The name of the Organization.")
-  slug = models.SlugField(max_length=200, help_text="The unique URL slug for this Organization.")
+  slug = models.SlugField(max_length=200, validators=[validate_organization_slug], help_text="The unique URL slug for this Organization.")
 
   description = models.TextField(blank=True, help_text="Descriptive text describing the Organization.")
 
@@ -57,9 +68,10 @@ class Campaign(models.Model):
   receipt_subject = models.CharField(max_length=128, help_text="The receipt email Subject: header.")
   receipt_template = models.TextField(help_text="Receipt email body text (plain text), as a Django template.")
 
-  # Totals.
-  total_contributors = models.IntegerField(default=0, help_text="A running total of the number of individuals who made a contribution through this Campaign.")
-  total_contributions = models.DecimalField(max_digits=10, decimal_places=2, default=0, help_text="A running total of contributions made through this Campaign.")
+  # Totals. These lag behind by the changes still in the CampaignCounterShards,
+  # which are folded in periodically. The Campaign admin adds those in.
+  total_contributors = models.IntegerField(default=0, help_text="A running total of the number of individuals who made a contribution through this Campaign, as of the last time the counter shards were folded in.")
+  total_contributions = models.DecimalField(max_digits=10, decimal_places=2, default=0, help_text="A running total of contributions made through this Campaign, as of the last time the counter shards were folded in.")
 
   # Additional data.
   extra = JSONField(blank=True, help_text="Additional information stored with this object.")
@@ -72,6 +84,53 @@ class Campaign(models.Model):
   def __str__(self):
     return "#%d %s (%s)" % (self.id, self.title, str(self.owner))
 
+class CampaignCounterShard(models.Model):
+  """Changes to a Campaign's totals that haven't been folded into the Campaign yet."""
+
+  # Every new Contribution would otherwise update the one Campaign row, and
+  # so checkouts would wait on each other for its lock. Instead each change
+  # goes to one of several rows picked at random, and the rows are added
+  # into the Campaign by fold() every so often.
+  NUM_SHARDS = 16
+
+  campaign = models.ForeignKey(Campaign, related_name="counter_shards", on_delete=models.CASCADE, help_text="The Campaign whose totals these are changes to.")
+  shard = models.IntegerField(help_text="Which of the Campaign's shards this is.")
+  contributors = models.IntegerField(default=0, help_text="The change to the Campaign's total_contributors.")
+  contributions = models.DecimalField(max_digits=10, decimal_places=2, default=0, help_text="The change to the Campaign's total_contributions.")
+
+  class Meta:
+    unique_together = [('campaign', 'shard')]
+
+  def __repr__(self):
+    return "<CampaignCounterShard(%d, %d, %d)>" % (self.campaign_id, self.shard, self.contributors)
+
+  @staticmethod
+  def add(campaign, contributors, contributions):
+    import random
+    shard = random.randrange(CampaignCounterShard.NUM_SHARDS)
+    update = lambda : CampaignCounterShard.objects.filter(campaign=campaign, shard=shard).update(
+      contributors=models.F('contributors') + contributors,
+      contributions=models.F('contributions') + contributions)
+    if not update():
+      # The shard row doesn't exist yet.
+      CampaignCounterShard.objects.get_or_create(campaign=campaign, shard=shard)
+      update()
+
+  @staticmethod
+  def fold(campaign_id):
+    # Move the changes in the shards into the Campaign's totals. The shards
+    # are locked so that no changes are lost in between.
+    with transaction.atomic():
+      shards = list(CampaignCounterShard.objects.select_for_update().filter(campaign_id=campaign_id).exclude(contributors=0, contributions=0))
+      if len(shards) == 0:
+        return
+      CampaignCounterShard.objects.filter(id__in=[s.id for s in shards]).update(contributors=0, contributions=0)
+      # update() leaves Campaign.updated alone, since nothing about the
+      # Campaign's content changed.
+      Campaign.objects.filter(id=campaign_id).update(
+        total_contributors=models.F('total_contributors') + sum(s.contributors for s in shards),
+        total_contributions=models.F('total_contributions') + sum(s.contributions for s in shards))
+
 class NoMassDeleteManager(models.Manager):
   class CustomQuerySet(models.QuerySet):
     def delete(self, *args, **kwargs):
@@ -84,6 +143,15 @@ class NoMassDeleteManager(models.Manager):
   def get_queryset(self):
     return NoMassDeleteManager.CustomQuerySet(self.model, using=self._db)
 
+CONTRIBUTION_STATUSES = (
+  ("pending", "Pending"), # not yet executed
+  ("ok", "OK"),
+  ("error", "Transaction Error"),
+  ("receipt-error", "Receipt Email Error"),
+  ("voided", "Voided"),
+  ("void-error", "Void Error"),
+)
+
 class Contribution(models.Model):
   """A contribution made by a user."""
 
@@ -93,10 +161,20 @@ class Contribution(models.Model):
   amount = models.DecimalField(max_digits=10, decimal_places=2, help_text="The contribution amount, in dollars --- the same amount the user's credit card was charged.")
   cclastfour = models.CharField(max_length=4, blank=True, null=True, db_index=True, help_text="The last four digits of the user's credit card number, stored & indexed for fast look-up in case we need to find a Contribution from a credit card number.")
 
+  # Copies of contributor fields, normalized and indexed for fast look-up. Set
+  # from contributor on save.
+  contributor_email = models.CharField(max_length=254, blank=True, null=True, db_index=True, help_text="The contributor's email address, lowercased.")
+  contributor_name = models.CharField(max_length=200, blank=True, null=True, db_index=True, help_text="The contributor's first and last name, lowercased.")
+  contributor_last_name = models.CharField(max_length=200, blank=True, null=True, db_index=True, help_text="The contributor's last name, lowercased, so that it can be searched on its own.")
+  contributor_zip = models.CharField(max_length=10, blank=True, null=True, db_index=True, help_text="The contributor's ZIP code.")
+  contributor_state = models.CharField(max_length=2, blank=True, null=True, db_index=True, help_text="The contributor's state, uppercased.")
+
   # Execution
   recipients = JSONField(help_text="A list of contribution recipients and the amount each recipient is receiving.")
   transaction = JSONField(blank=True, help_text="The Democracy Engine transaction record.")
   receipt_sent_at = models.DateTimeField(blank=True, null=True, help_text="If set, the datetime when a receipt email was sent to the contributor. If empty, the email has not yet been sent.")
+  status = models.CharField(max_length=16, choices=CONTRIBUTION_STATUSES, default="pending", db_index=True, help_text="A summary of transaction and extra, set on save, for listing and filtering Contributions.")
+  reconciled_fingerprint = models.CharField(max_length=40, blank=True, null=True, db_index=True, help_text="Set by the reconcile management command when this Contribution last matched its Democracy Engine donation record, so that it can be skipped until either changes. If empty, it has not yet been reconciled without issues.")
 
   # Meta.
   ref_code = models.CharField(max_length=24, blank=True, null=True, db_index=True, help_text="An optional referral code that lead the user to take this action, e.g. from a utm_campaign query string argument.")
@@ -118,14 +196,47 @@ class Contribution(models.Model):
     # counters on the Campaign.
     is_new = (not self.id) # if the pk evaluates to false, Django does an INSERT
 
-    # Actually save().
-    super(Contribution, self).save(*args, **kwargs)
-
-    # For a new object, increment the Campaign's counters.
-    if is_new:
-      self.campaign.total_contributors = models.F('total_contributors') + 1
-      self.campaign.total_contributions = models.F('total_contributions') + self.amount
-      self.campaign.save(update_fields=['total_contributors', 'total_contributions'])
+    # Keep the look-up columns in sync with the contributor JSON.
+    self.update_contributor_columns()
+
+    # Keep the status in sync with transaction and extra, including when
+    # only some fields are being saved.
+    self.status = self.compute_status()
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and set(update_fields) & {'transaction', 'extra', 'receipt_sent_at'}:
+      kwargs['update_fields'] = list(update_fields) + ['status']
+
+    with timed("contribution-save"):
+      # Actually save().
+      super(Contribution, self).save(*args, **kwargs)
+
+      # For a new object, increment the Campaign's counters.
+      if is_new:
+        CampaignCounterShard.add(self.campaign, 1, self.amount)
+
+  def update_contributor_columns(self):
+    contributor = self.contributor or { }
+    def normalize(key, max_length):
+      value = " ".join(str(contributor.get(key) or "").split())
+      return value[:max_length] or None
+    self.contributor_email = normalize_email(contributor.get("email"))
+    self.contributor_name = normalize_name(contributor.get("nameFirst"), contributor.get("nameLast"))
+    self.contributor_last_name = normalize_name(contributor.get("nameLast"))
+    self.contributor_zip = normalize("zip", 10)
+    self.contributor_state = (normalize("state", 2) or "").upper() or None
+
+  def compute_status(self):
+    if self.extra and self.extra.get("void"):
+      if all(v.get("method") for v in self.extra["void"]):
+        return "voided"
+      return "void-error"
+    if not self.transaction:
+      return "pending"
+    if self.transaction.get("error"):
+      return "error"
+    if self.extra and self.extra.get("error_sending_receipt"):
+      return "receipt-error"
+    return "ok"
 
   def delete(self):
     if self.transaction:
@@ -135,9 +246,7 @@ class Contribution(models.Model):
     super(Contribution, self).delete()  
 
   def decrement(self):
-    self.campaign.total_contributors = models.F('total_contributors') - 1
-    self.campaign.total_contributions = models.F('total_contributions') - self.amount
-    self.campaign.save(update_fields=['total_contributors', 'total_contributions'])
+    CampaignCounterShard.add(self.campaign, -1, -self.amount)
 
   def void(self):
     # A user has asked us to void a transaction.
@@ -212,10 +321,12 @@ class Contribution(models.Model):
           output.append((txn_guid, str(e) + "/" + str(e1)))
           continue
 
-    # Store result.
+    # Store result. Clear the reconciled fingerprint so that the reconcile
+    # command checks this Contribution against Democracy Engine again.
     if len(voids) > 0:
       self.extra['void'] = voids
-      self.save(update_fields=["extra"])
+      self.reconciled_fingerprint = None
+      self.save(update_fields=["extra", "reconciled_fingerprint"])
 
     if successful:
       self.decrement()
@@ -248,3 +359,131 @@ class Contribution(models.Model):
     return ' '.join(
       self.contributor[k] for k in ('email', 'nameFirst', 'nameLast', 'city', 'state')
       )
+
+def normalize_email(email):
+  # How email addresses are stored in Contribution.contributor_email.
+  return str(email or "").strip().lower()[:254] or None
+
+def normalize_name(*parts):
+  # How names are stored in Contribution.contributor_name and
+  # contributor_last_name.
+  return " ".join(" ".join(str(p or "") for p in parts).split()).lower()[:200] or None
+
+class PaymentJob(models.Model):
+  """A queued request to execute the payment for a Contribution."""
+
+  # States.
+  STATES = (
+    ("queued", "Queued"),
+    ("running", "Running"),
+    ("finished", "Finished"),
+  )
+
+  key = models.CharField(max_length=32, unique=True, help_text="A random identifier for this job given to the user so that they can check its status.")
+  contribution = models.OneToOneField(Contribution, blank=True, null=True, on_delete=models.SET_NULL, related_name="payment_job", help_text="The Contribution to execute. Cleared if the Contribution is deleted because the payment failed validation.")
+  payment = JSONField(blank=True, help_text="A Democracy Engine token for the contributor's card, never the card itself. Cleared as soon as the job is finished.")
+
+  # Status.
+  state = models.CharField(max_length=12, choices=STATES, default="queued", db_index=True, help_text="Whether this job is waiting for a worker, being run by a worker, or finished.")
+  attempts = models.IntegerField(default=0, help_text="The number of times a worker has started this job.")
+  claimed_at = models.DateTimeField(blank=True, null=True, db_index=True, help_text="When a worker last started this job. A job that has been running for too long is assumed to have been abandoned by a worker that stopped.")
+  run_after = models.DateTimeField(default=now, db_index=True, help_text="Workers won't start this job before this time, so that retries back off.")
+  result = JSONField(blank=True, help_text="Once the job is finished, the response to give the user.")
+
+  created = models.DateTimeField(auto_now_add=True, db_index=True)
+  updated = models.DateTimeField(auto_now=True, db_index=True)
+
+  def __repr__(self):
+    return "<PaymentJob(%d, %s, %s)>" % (self.id, repr(self.contribution), self.state)
+
+  @staticmethod
+  def claim():
+    # Take the next job that is ready to run, marking it as running so
+    # that no other worker takes it, or return None if there are none.
+    for job in PaymentJob.objects.filter(state="queued", run_after__lte=now()).order_by('run_after')[0:10]:
+      # Another worker may take the job first, in which case this
+      # updates nothing.
+      if PaymentJob.objects.filter(id=job.id, state="queued").update(state="running", attempts=models.F('attempts') + 1, claimed_at=now()):
+        job.refresh_from_db()
+        return job
+    return None
+
+class OutgoingReceipt(models.Model):
+  """A receipt email waiting to be sent."""
+
+  contribution = models.OneToOneField(Contribution, on_delete=models.CASCADE, related_name="outgoing_receipt", help_text="The Contribution to send a receipt for.")
+  attempts = models.IntegerField(default=0, help_text="The number of times sending this receipt has failed.")
+  last_error = models.TextField(blank=True, help_text="The error from the last failed attempt to send this receipt.")
+  send_after = models.DateTimeField(default=now, db_index=True, help_text="The receipt won't be sent before this time, so that retries back off.")
+  created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+  def __repr__(self):
+    return "<OutgoingReceipt(%d, %s)>" % (self.id, repr(self.contribution))
+
+class VoidJob(models.Model):
+  """A request from the admin to void a batch of Contributions in the background."""
+
+  # States.
+  STATES = (
+    ("queued", "Queued"),
+    ("running", "Running"),
+    ("finished", "Finished"),
+  )
+
+  results = JSONField(help_text="A list of [contribution ID, result] pairs, one for each Contribution to void. The result is null until the void has been attempted, and then it is the status text returned by Contribution.void() or the error that it raised.")
+
+  # Status.
+  state = models.CharField(max_length=12, choices=STATES, default="queued", db_index=True, help_text="Whether this job is waiting for a worker, being run by a worker, or finished.")
+  claimed_at = models.DateTimeField(blank=True, null=True, db_index=True, help_text="When a worker started this job or last saved a result. A running job whose worker hasn't done either for too long is assumed to have been abandoned and is resumed by another worker.")
+  created = models.DateTimeField(auto_now_add=True, db_index=True)
+  updated = models.DateTimeField(auto_now=True, db_index=True)
+
+  # Seconds after which a running job that hasn't saved a result is assumed
+  # to have been abandoned by a worker that stopped. Each void makes a few
+  # Democracy Engine calls, which take well under this.
+  LEASE = 10*60
+
+  def __repr__(self):
+    return "<VoidJob(%d, %s)>" % (self.id, self.state)
+
+  def progress(self):
+    return "%d of %d" % (sum(1 for r in self.results if r[1] is not None), len(self.results))
+
+  @staticmethod
+  def claim():
+    # Take the oldest queued or abandoned job, marking it as running so
+    # that no other worker takes it, or return None if there are none.
+    # An abandoned job is resumed from the Contributions that don't have
+    # a result yet. Jobs started before claimed_at was recorded have no
+    # time and are also treated as abandoned.
+    from datetime import timedelta
+    abandoned = models.Q(state="running") & (models.Q(claimed_at__lt=now() - timedelta(seconds=VoidJob.LEASE)) | models.Q(claimed_at=None))
+    for job in VoidJob.objects.filter(models.Q(state="queued") | abandoned).order_by('created')[0:10]:
+      # Another worker may take the job first, in which case this
+      # updates nothing.
+      if VoidJob.objects.filter(id=job.id, state=job.state, claimed_at=job.claimed_at).update(state="running", claimed_at=now()):
+        job.refresh_from_db()
+        return job
+    return None
+
+class IdempotencyKey(models.Model):
+  """The response to a contribution form submission, by the random key that the form sent with it, so that a resubmission gets the same response rather than executing the contribution again."""
+
+  key = models.CharField(max_length=64, unique=True, help_text="The random key that the contribution form sent with the submission.")
+  campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, help_text="The Campaign whose form was submitted.")
+  contribution = models.ForeignKey(Contribution, blank=True, null=True, on_delete=models.SET_NULL, help_text="The Contribution created by the first submission with this key, set before it is executed.")
+  response = JSONField(blank=True, null=True, help_text="The response to the first submission with this key, or null while it is being processed.")
+  created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+  def __repr__(self):
+    return "<IdempotencyKey(%d, %s)>" % (self.id, self.key)
+
+class ReconcileCheckpoint(models.Model):
+  """How far the reconcile management command has gotten, so that each run only reads what is new since the last one. There is at most one."""
+
+  contribution_id = models.IntegerField(default=0, help_text="The ID of a Contribution such that it and every earlier Contribution have been reconciled without issues.")
+  contribution_created = models.DateTimeField(blank=True, null=True, help_text="When that Contribution was created. Donations are fetched from Democracy Engine starting from this date.")
+  updated = models.DateTimeField(auto_now=True)
+
+  def __repr__(self):
+    return "<ReconcileCheckpoint(%d)>" % self.contribution_id
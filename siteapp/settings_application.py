@@ -4,9 +4,36 @@ INSTALLED_APPS += [
 	'siteapp'
 ]
 
+# Time each request and the slow phases within it. Put it first so that
+# the other middleware is included in the time.
+MIDDLEWARE_CLASSES.insert(0, 'siteapp.metrics.RequestTimingMiddleware')
+
 DE_API = environment.get('democracyengine')
 MIXPANEL_KEY = environment.get('mixpanel_key')
 
+# If set, payments are queued and executed by the execute_payments
+# management command rather than during the request. The request still
+# exchanges the card for a Democracy Engine token, so it still waits on
+# one Democracy Engine call (with the 20 second timeout for live requests),
+# but not on the charge or the receipt. It's a dict with
+# optional keys "workers" (the number of jobs run at once), "max_attempts"
+# (for jobs that could not connect to Democracy Engine), and
+# "retry_backoff" (seconds before the first retry, doubling after), and
+# "lease" (seconds after which a running job is assumed to have been
+# abandoned by a worker that stopped, default 600).
+PAYMENT_QUEUE = environment.get('payment-queue')
+
+# If set, receipt emails are queued and sent in batches by the send_receipts
+# management command rather than during the request. It's a dict with
+# optional keys "batch_size" (the most emails sent over one connection),
+# "max_attempts", and "retry_backoff" (seconds before the first retry,
+# doubling after).
+RECEIPT_OUTBOX = environment.get('receipt-outbox')
+
+# The most seconds a web request runs before uwsgi kills it. This must
+# match --harakiri in deployment/supervisor.conf.
+REQUEST_TIME_LIMIT = 300
+
 SERVER_EMAIL = 'newdems error <errors@mail.if.then.fund>'
 RECEIPT_FROM_EMAIL = 'no-reply@mail.if.then.fund'
 RECEIPT_REPLY_TO = 'ideas@if.then.fund'
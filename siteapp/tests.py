@@ -0,0 +1,596 @@
+import csv
+import io
+import json
+import random
+from contextlib import redirect_stdout
+from datetime import timedelta
+from decimal import Decimal, ROUND_DOWN
+from unittest import mock
+
+from django.contrib import admin
+from django.core import mail
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import TestCase, Client, override_settings
+from django.utils.timezone import now
+
+from . import views
+from .models import alg, Organization, Campaign, CampaignCounterShard, Contribution, PaymentJob, OutgoingReceipt, IdempotencyKey, VoidJob, ReconcileCheckpoint
+from .de import DummyDemocracyEngineAPIClient
+from .export import EXPORT_COLUMNS
+from .management.commands import execute_voids
+
+# The split algorithm before it was rewritten to work in integer cents, kept
+# here to check that the rewrite gives the same line items.
+
+def baseline_compute_line_items(recipients, amount, random_seed):
+  line_items = baseline_split_contribution_to_recipients(
+    [recip for recip in recipients if "points" in recip],
+    amount,
+    random_seed)
+
+  overflow_recipients = [recip for recip in recipients if "points" not in recip]
+  while True:
+    remaining = amount - sum(line_item[1] for line_item in line_items)
+    if remaining == 0:
+      break
+    if len(overflow_recipients) == 0:
+      raise ValueError("The amount is greater than the maximum contribution by $%s." % remaining)
+    recip = overflow_recipients.pop(0)
+    line_items.append( (recip, min(remaining, views.get_recipient_limit(recip)) ) )
+
+  line_items.sort(key = lambda line_item : views.recipient_sort_key(line_item[0]))
+  return line_items
+
+def baseline_split_contribution_to_recipients(recipients, amount, random_seed):
+  if len(recipients) == 0:
+    return []
+
+  total_points = sum(Decimal(recip["points"]) for recip in recipients)
+
+  fixed_line_items = []
+  free_line_items = []
+  for recip in recipients:
+    recip_amount = views.round_to_cents(amount * recip["points"] / total_points, ROUND_DOWN)
+    if recip_amount < Decimal("0.01"):
+      raise ValueError("The amount is too small.")
+    if recip_amount > alg["limits"][recip["type"]]:
+      fixed_line_items.append( (recip, alg["limits"][recip["type"]]) )
+    else:
+      free_line_items.append( (recip, recip_amount) )
+
+  if len(fixed_line_items) == 0:
+    rand = random.Random(random_seed)
+    dist_recipients = list(range(len(free_line_items)))
+    rand.shuffle(dist_recipients)
+
+    remaining_amount = amount - sum(line_item[1] for line_item in free_line_items)
+    rnext = 0
+    for _ in range(int(remaining_amount*100)):
+      for i in range(len(dist_recipients)):
+        line_item_index = dist_recipients[(rnext + i) % len(dist_recipients)]
+        if views.get_recipient_limit(free_line_items[line_item_index][0]) > free_line_items[line_item_index][1]:
+          break
+      else:
+        break
+      free_line_items[line_item_index] = (free_line_items[line_item_index][0], free_line_items[line_item_index][1]+Decimal("0.01"))
+      rnext += 1
+
+    return free_line_items
+
+  remaining_recipients = [line_item[0] for line_item in free_line_items]
+  remaining_amount = amount - sum(line_item[1] for line_item in fixed_line_items)
+  return fixed_line_items + baseline_split_contribution_to_recipients(remaining_recipients, remaining_amount, random_seed)
+
+def make_random_recipients(rand):
+  recipients = []
+  for i in range(rand.randint(1, 30)):
+    recipients.append({
+      "id": "R%d" % i,
+      "name": "Recipient %d" % i,
+      "de_recipient_id": "DE%d" % i,
+      "type": rand.choice(["candidate", "candidate", "candidate", "pac", "c4"]),
+      "points": rand.choice([1, 1, 2, 3, 5, 40, 200]),
+    })
+  for i in range(rand.randint(0, 2)):
+    recipients.append({
+      "id": "O%d" % i,
+      "name": "Overflow %d" % i,
+      "de_recipient_id": "DEO%d" % i,
+      "type": rand.choice(["pac", "c4"]),
+    })
+  return recipients
+
+class SplitTests(TestCase):
+  def test_matches_baseline(self):
+    rand = random.Random(1)
+    for _ in range(300):
+      recipients = make_random_recipients(rand)
+      low = views.compute_minimum_contribution(recipients)
+      high = views.compute_maximum_contribution(recipients)
+      amount = views.from_cents(rand.randint(views.to_cents(low), views.to_cents(high)))
+      seed = str(rand.getrandbits(32))
+      expected = [(recip["id"], str(value)) for recip, value in baseline_compute_line_items(recipients, amount, seed)]
+      actual = [(recip["id"], str(value)) for recip, value in views.compute_line_items(recipients, amount, seed)]
+      self.assertEqual(actual, expected, (recipients, amount, seed))
+
+  def test_amount_too_large(self):
+    recipients = [{ "id": "A", "name": "A", "type": "candidate", "points": 1 }]
+    with self.assertRaises(ValueError):
+      views.compute_line_items(recipients, alg["limits"]["candidate"] + Decimal("0.01"), "1")
+
+class ContributionTestCase(TestCase):
+  execute_fields = {
+    "method": "execute", "amount": "25.00", "rstate": "12345", "disabled-recipients": "",
+    "email": "test@example.com", "nameFirst": "Test", "nameLast": "Person",
+    "phone": "202-555-1234", "address": "1 Main St", "city": "Washington", "state": "DC", "zip": "20001",
+    "occupation": "Tester", "employer": "None",
+    "ccNum": "4111111111111111", "ccExpMonth": "2", "ccExpYear": "2030", "ccCVV": "123",
+  }
+  preview_fields = { "method": "preview", "amount": "10.00", "rstate": "12345", "disabled-recipients": "" }
+
+  def setUp(self):
+    self.org = Organization.objects.create(name="Test", slug="test-org", extra={})
+    self.campaign = Campaign.objects.create(
+      owner=self.org, title="Test", slug="test", active=True,
+      headline="Test", subhead="Test", body="Test",
+      suggested_amount=Decimal("25"),
+      recipients=[
+        { "id": "A", "name": "A", "de_recipient_id": "DEA", "type": "candidate", "points": 1 },
+        { "id": "B", "name": "B", "de_recipient_id": "DEB", "type": "candidate", "points": 2 },
+        { "id": "P", "name": "PAC", "de_recipient_id": "DEP", "type": "pac" },
+      ],
+      receipt_sender="Test", receipt_subject="Receipt", receipt_template="Thanks for {{amount}}.",
+      extra={})
+    self.url = "/%s/%s" % (self.org.slug, self.campaign.slug)
+    self.client = Client()
+
+    # Keep Democracy Engine and email deliverability checks local.
+    validate_email = views.validate_email
+    for patcher in (
+      mock.patch.object(views, "DemocracyEngineAPI", DummyDemocracyEngineAPIClient()),
+      mock.patch.object(views, "validate_email", lambda email : validate_email(email, check_deliverability=False)),
+      ):
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def post(self, **data):
+    response = self.client.post(self.url, dict(self.execute_fields, **data))
+    self.assertEqual(response.status_code, 200)
+    return json.loads(response.content.decode("utf8"))
+
+@override_settings(PAYMENT_QUEUE={ "workers": 1 }, RECEIPT_OUTBOX=None)
+class PaymentQueueTests(ContributionTestCase):
+  def test_queued_job_holds_no_card_data(self):
+    result = self.post()
+    self.assertEqual(result["status"], "queued")
+
+    job = PaymentJob.objects.get(key=result["job"])
+    self.assertEqual(set(job.payment), { "token" })
+    self.assertNotIn(self.execute_fields["ccNum"], json.dumps(job.payment))
+
+    job = PaymentJob.claim()
+    views.run_payment_job(job)
+    job.refresh_from_db()
+    self.assertEqual(job.state, "finished")
+    self.assertEqual(job.result, { "status": "ok" })
+    self.assertEqual(job.payment, { })
+    self.assertEqual(job.contribution.status, "ok")
+
+  def test_declined_card_is_not_queued(self):
+    result = self.post(ccNum="4111111111111112")
+    self.assertEqual(result["status"], "invalid")
+    self.assertFalse(PaymentJob.objects.exists())
+    self.assertFalse(Contribution.objects.exists())
+
+  def test_abandoned_job_is_failed_not_rerun(self):
+    result = self.post()
+    job = PaymentJob.claim()
+    PaymentJob.objects.filter(id=job.id).update(claimed_at=None)
+
+    with mock.patch.object(views.DemocracyEngineAPI, "create_donation") as create_donation:
+      views.fail_abandoned_payment_jobs()
+    create_donation.assert_not_called()
+
+    job.refresh_from_db()
+    self.assertEqual(job.state, "finished")
+    self.assertEqual(job.payment, { })
+    self.assertEqual(job.contribution.status, "error")
+    self.assertEqual(self.client.get("/payment/" + result["job"]).json(), { "status": "ok" })
+
+@override_settings(PAYMENT_QUEUE=None, RECEIPT_OUTBOX=None)
+class IdempotencyKeyTests(ContributionTestCase):
+  def post_once(self, **data):
+    return self.post(**dict({ "idempotency-key": "k" * 20 }, **data))
+
+  def make_stale(self):
+    IdempotencyKey.objects.update(response=None,
+      created=now() - timedelta(seconds=views.IDEMPOTENT_REQUEST_TIMEOUT + 1))
+
+  def test_replay_returns_first_response(self):
+    self.assertEqual(self.post_once()["status"], "ok")
+    self.assertEqual(self.post_once()["status"], "ok")
+    self.assertEqual(Contribution.objects.count(), 1)
+
+  def test_invalid_submission_releases_key(self):
+    self.assertEqual(self.post_once(email="not-an-email")["status"], "invalid")
+    self.assertFalse(IdempotencyKey.objects.exists())
+    self.assertEqual(self.post_once()["status"], "ok")
+
+  def test_running_request_is_pending(self):
+    IdempotencyKey.objects.create(key="k" * 20, campaign=self.campaign)
+    self.assertEqual(self.post_once(), { "status": "pending" })
+    self.assertFalse(Contribution.objects.exists())
+
+  def test_dead_request_without_contribution_is_taken_over(self):
+    IdempotencyKey.objects.create(key="k" * 20, campaign=self.campaign)
+    self.make_stale()
+    self.assertEqual(self.post_once()["status"], "ok")
+    self.assertEqual(Contribution.objects.count(), 1)
+
+  def test_dead_request_with_contribution_is_not_rerun(self):
+    self.post_once()
+    contribution = Contribution.objects.get()
+    Contribution.objects.update(transaction={ })
+    self.make_stale()
+
+    with mock.patch.object(views.DemocracyEngineAPI, "create_donation") as create_donation:
+      self.assertEqual(self.post_once(), { "status": "ok" })
+    create_donation.assert_not_called()
+    self.assertEqual(Contribution.objects.count(), 1)
+    contribution.refresh_from_db()
+    self.assertEqual(contribution.status, "error")
+    self.assertEqual(IdempotencyKey.objects.get().response, { "status": "ok" })
+
+  @override_settings(PAYMENT_QUEUE={ "workers": 1 })
+  def test_dead_request_with_payment_job_is_queued(self):
+    job_key = self.post_once()["job"]
+    self.make_stale()
+    self.assertEqual(self.post_once(), { "status": "queued", "job": job_key })
+    self.assertEqual(PaymentJob.objects.count(), 1)
+
+class CampaignLookupTests(ContributionTestCase):
+  def test_campaign_url(self):
+    self.assertEqual(views.get_campaign("test-org", "test"), self.campaign)
+    self.assertEqual(self.client.post(self.url, self.preview_fields).status_code, 200)
+    self.assertEqual(self.client.post("/test-org/other", self.preview_fields).status_code, 404)
+
+  def test_inactive_campaign_is_not_found(self):
+    self.campaign.active = False
+    self.campaign.save()
+    with self.assertRaises(views.Http404):
+      views.get_campaign("test-org", "test")
+
+  def test_reserved_organization_slug(self):
+    for slug in ("admin", "Visitor-Info", "payment"):
+      with self.assertRaises(ValidationError):
+        Organization(name="Test", slug=slug, extra={ "x": 1 }).full_clean()
+    Organization(name="Test", slug="test-org-2", extra={ "x": 1 }).full_clean()
+
+  def test_saving_clears_cache(self):
+    views.get_campaign("test-org", "test")
+    self.org.slug = "renamed"
+    self.org.save()
+    with self.assertRaises(views.Http404):
+      views.get_campaign("test-org", "test")
+    self.assertEqual(views.get_campaign("renamed", "test"), self.campaign)
+
+  def test_change_in_another_process_expires(self):
+    # A save in another process doesn't clear this process's cache when
+    # the cache isn't shared, so simulate one with update().
+    views.get_campaign("test-org", "test")
+    Campaign.objects.filter(id=self.campaign.id).update(title="Changed")
+    self.assertEqual(views.get_campaign("test-org", "test").title, "Test")
+    later = views.time.time() + views.CAMPAIGN_CACHE_TTL + 1
+    with mock.patch.object(views.time, "time", lambda : later):
+      self.assertEqual(views.get_campaign("test-org", "test").title, "Changed")
+
+class VoidJobTests(TestCase):
+  def run_job(self, job):
+    voided = []
+    def void_contribution(contribution_id):
+      voided.append(contribution_id)
+      return "Voided."
+    with mock.patch.object(execute_voids, "void_contribution", void_contribution):
+      execute_voids.Command().run_job(job, 2)
+    return voided
+
+  def test_running_job_is_not_taken(self):
+    job = VoidJob.objects.create(results=[[1, None]])
+    self.assertEqual(VoidJob.claim(), job)
+    self.assertIsNone(VoidJob.claim())
+
+  def test_abandoned_job_is_resumed(self):
+    VoidJob.objects.create(results=[[1, "Voided."], [2, None], [3, None]], state="running",
+      claimed_at=now() - timedelta(seconds=VoidJob.LEASE + 1))
+    job = VoidJob.claim()
+    self.assertIsNotNone(job)
+    self.assertIsNone(VoidJob.claim())
+
+    self.assertEqual(sorted(self.run_job(job)), [2, 3])
+    job.refresh_from_db()
+    self.assertEqual(job.state, "finished")
+    self.assertEqual(job.results, [[1, "Voided."], [2, "Voided."], [3, "Voided."]])
+
+class ReconcileTests(ContributionTestCase):
+  def setUp(self):
+    super(ReconcileTests, self).setUp()
+    self.donations = [self.make_contribution() for _ in range(2)]
+
+  def make_contribution(self):
+    contributor = { "nameFirst": "Test", "nameLast": "Person", "address": "1 Main St", "city": "Washington",
+      "state": "DC", "zip": "20001", "employer": "None", "occupation": "Tester", "email": "test@example.com" }
+    contribution = Contribution.objects.create(
+      campaign=self.campaign, amount=Decimal("10.00"), contributor=contributor,
+      recipients=[[{ "de_recipient_id": "DEA" }, "10.00"]], extra={ })
+    donation = {
+      "donation_id": "D%d" % contribution.id, "authtest_request": False, "authcapture_request": True,
+      "aux_data": { "contribution": contribution.id },
+      "donor_first_name": "Test", "donor_last_name": "Person", "donor_address1": "1 Main St",
+      "donor_city": "Washington", "donor_state": "DC", "donor_zip": "20001",
+      "compliance_employer": "None", "compliance_occupation": "Tester",
+      "line_items": [{ "recipient_id": "DEA", "recipient_name": "A", "amount": "$10.00",
+        "transaction_guid": "T%d" % contribution.id, "status": "captured", "transaction_error": None }],
+    }
+    contribution.transaction = donation
+    contribution.save(update_fields=['transaction'])
+    return donation
+
+  def reconcile(self):
+    self.api = mock.Mock()
+    self.api.donations.side_effect = lambda start_date=None : list(self.donations)
+    self.api.get_donation.side_effect = lambda donation_id : [don for don in self.donations if don["donation_id"] == donation_id][0]
+    output = io.StringIO()
+    with mock.patch("siteapp.management.commands.reconcile.DemocracyEngineAPI", self.api), redirect_stdout(output):
+      call_command("reconcile")
+    return output.getvalue()
+
+  def test_checkpoint(self):
+    self.assertEqual(self.reconcile(), "")
+    self.api.donations.assert_called_once_with()
+    checkpoint = ReconcileCheckpoint.objects.get()
+    self.assertEqual(checkpoint.contribution_id, self.donations[1]["aux_data"]["contribution"])
+
+    # Later runs only ask for donations since the checkpoint, and only
+    # check the ones after it.
+    self.donations.append(self.make_contribution())
+    self.donations[0]["donor_city"] = "Elsewhere"
+    self.assertEqual(self.reconcile(), "")
+    self.assertEqual(self.api.donations.call_args[1]["start_date"], (checkpoint.contribution_created - timedelta(days=1)).date())
+    self.assertEqual(ReconcileCheckpoint.objects.get().contribution_id, self.donations[2]["aux_data"]["contribution"])
+
+    # The checkpoint stops before a Contribution with issues.
+    self.donations.append(self.make_contribution())
+    self.donations[3]["donor_zip"] = "00000"
+    self.assertIn("mismatch in donor_zip", self.reconcile())
+    self.assertIn("mismatch in donor_zip", self.reconcile())
+    self.assertEqual(ReconcileCheckpoint.objects.get().contribution_id, self.donations[2]["aux_data"]["contribution"])
+
+  def test_void_before_checkpoint(self):
+    self.assertEqual(self.reconcile(), "")
+
+    # A void clears the fingerprint, which the next run notices even
+    # though the Contribution is before the checkpoint.
+    contribution = Contribution.objects.get(id=self.donations[0]["aux_data"]["contribution"])
+    with mock.patch.object(views.DemocracyEngineAPI, "get_transaction", return_value={ "status": "captured" }, create=True), \
+      mock.patch.object(views.DemocracyEngineAPI, "void_transaction", create=True):
+      contribution.void()
+    self.assertIn("should be voided", self.reconcile())
+    self.api.get_donation.assert_called_once_with(self.donations[0]["donation_id"])
+
+    self.donations[0]["line_items"][0]["status"] = "voided"
+    self.assertEqual(self.reconcile(), "")
+    self.assertEqual(self.reconcile(), "")
+    self.api.get_donation.assert_not_called()
+
+class PreviewBatchAmountsTests(TestCase):
+  def test_list(self):
+    self.assertEqual(views.parse_preview_batch_amounts({ "amounts": "5;10.5;250.00" }),
+      [Decimal("5.00"), Decimal("10.50"), Decimal("250.00")])
+
+  def test_range(self):
+    self.assertEqual(views.parse_preview_batch_amounts({ "amount_start": "10", "amount_stop": "12", "amount_step": "0.50" }),
+      [Decimal("10.00"), Decimal("10.50"), Decimal("11.00"), Decimal("11.50"), Decimal("12.00")])
+    self.assertEqual(views.parse_preview_batch_amounts({ "amount_start": "12", "amount_stop": "10", "amount_step": "1" }), [])
+
+  def test_invalid(self):
+    for postdata in (
+      { "amounts": "NaN" },
+      { "amounts": "5;Infinity" },
+      { "amounts": "5;1.001" },
+      { "amounts": "5;x" },
+      { "amount_start": "NaN", "amount_stop": "10", "amount_step": "1" },
+      { "amount_start": "1", "amount_stop": "10", "amount_step": "0" },
+      { "amount_start": "1", "amount_stop": "10" },
+      ):
+      with self.assertRaises(ValueError):
+        views.parse_preview_batch_amounts(postdata)
+
+  def test_too_many(self):
+    max_amounts = views.MAX_PREVIEW_BATCH_AMOUNTS
+    self.assertEqual(len(views.parse_preview_batch_amounts({ "amounts": ";".join(["5"] * max_amounts) })), max_amounts)
+    with self.assertRaises(ValueError):
+      views.parse_preview_batch_amounts({ "amounts": ";".join(["5"] * (max_amounts + 1)) })
+    with self.assertRaises(ValueError):
+      views.parse_preview_batch_amounts({ "amount_start": "1", "amount_stop": "1000000", "amount_step": "0.01" })
+
+class PreviewTests(ContributionTestCase):
+  def test_nan_amount(self):
+    for data in (
+      dict(self.preview_fields, amount="NaN"),
+      dict(self.preview_fields, method="preview-batch", amounts="NaN"),
+      ):
+      response = self.client.post(self.url, data)
+      self.assertEqual(response.status_code, 200)
+      self.assertEqual(response.json()["status"], "invalid")
+
+class MaximumContributionTests(TestCase):
+  def test_maximum_is_split(self):
+    recipients = [
+      { "id": "A", "name": "A", "type": "candidate", "points": 1 },
+      { "id": "B", "name": "B", "type": "candidate", "points": 3 },
+      { "id": "P", "name": "P", "type": "pac" },
+    ]
+    maximum = views.compute_maximum_contribution(recipients)
+    self.assertEqual(maximum, 2 * alg["limits"]["candidate"] + alg["limits"]["pac"])
+    self.assertEqual(sum(amount for recip, amount in views.compute_line_items(recipients, maximum, "1")), maximum)
+    with self.assertRaises(ValueError):
+      views.compute_line_items(recipients, maximum + Decimal("0.01"), "1")
+
+  def test_maximum_that_cannot_be_split(self):
+    # If the limits were inconsistent so that the maximum couldn't be
+    # split, computing it raises ValueError rather than returning it.
+    recipients = [{ "id": "A", "name": "A", "type": "candidate", "points": 1 }]
+    with mock.patch.object(views, "get_recipient_limit", lambda recip : alg["limits"]["candidate"] + 1):
+      with self.assertRaises(ValueError):
+        views.compute_maximum_contribution(recipients)
+
+class CounterShardTests(ContributionTestCase):
+  def test_fold(self):
+    for amount in ("10.00", "25.50", "100.00"):
+      Contribution.objects.create(campaign=self.campaign, amount=Decimal(amount), contributor={ }, recipients=[], transaction={ }, extra={ })
+    Contribution.objects.order_by('id').first().delete()
+
+    self.campaign.refresh_from_db()
+    self.assertEqual(self.campaign.total_contributors, 0)
+
+    # The admin shows the totals with the changes that haven't been folded in.
+    campaign_admin = admin.site._registry[Campaign]
+    campaign = campaign_admin.get_queryset(None).get(id=self.campaign.id)
+    self.assertEqual(campaign_admin.current_total_contributors(campaign), 2)
+    self.assertEqual(campaign_admin.current_total_contributions(campaign), Decimal("125.50"))
+
+    CampaignCounterShard.fold(self.campaign.id)
+    self.campaign.refresh_from_db()
+    self.assertEqual(self.campaign.total_contributors, 2)
+    self.assertEqual(self.campaign.total_contributions, Decimal("125.50"))
+    self.assertFalse(CampaignCounterShard.objects.exclude(contributors=0, contributions=0).exists())
+
+class ContributionSearchTests(ContributionTestCase):
+  def search(self, search_term):
+    contribution_admin = admin.site._registry[Contribution]
+    results, use_distinct = contribution_admin.get_search_results(None, Contribution.objects.all(), search_term)
+    return list(results)
+
+  def test_search(self):
+    contribution = Contribution.objects.create(campaign=self.campaign, amount=Decimal("10.00"),
+      contributor={ "email": "Test@Example.com", "nameFirst": "Test", "nameLast": "Person", "zip": "20001" },
+      recipients=[], transaction={ }, extra={ })
+    for search_term in ("test@example.com", "Test", "test per", "Person", "pers", "20001"):
+      self.assertEqual(self.search(search_term), [contribution], search_term)
+    for search_term in ("other@example.com", "Person Test", "erson"):
+      self.assertEqual(self.search(search_term), [], search_term)
+
+class FormPageTests(ContributionTestCase):
+  def test_etag(self):
+    response = self.client.get(self.url)
+    self.assertEqual(response.status_code, 200)
+    etag = response["ETag"]
+
+    response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 304)
+    self.assertEqual(response["ETag"], etag)
+
+    # Changing the Campaign changes the page.
+    self.campaign.headline = "Changed"
+    self.campaign.save()
+    response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 200)
+    self.assertNotEqual(response["ETag"], etag)
+    self.assertIn("Changed", response.content.decode("utf8"))
+
+  def test_visitor_info(self):
+    response = self.client.get("/visitor-info")
+    self.assertEqual(response.status_code, 200)
+    self.assertIn("no-cache", response["Cache-Control"])
+    info = response.json()
+    self.assertEqual(set(info), { "rstate", "random_user_info", "csrf_token" })
+    self.assertIn("csrftoken", response.cookies)
+
+class PreviewCacheTests(ContributionTestCase):
+  def key(self, amount="10.00", disabled_recipients=("",), random_seed="1"):
+    return views.get_preview_cache_key(self.campaign, views.parse_amount(amount), list(disabled_recipients), random_seed)
+
+  def test_cache_key(self):
+    # Equivalent requests share a key.
+    self.assertEqual(self.key("10"), self.key("10.00"))
+    self.assertEqual(self.key(disabled_recipients=("B", "A")), self.key(disabled_recipients=("A", "B", "A")))
+    self.assertEqual(self.key(disabled_recipients=("A", "unknown")), self.key(disabled_recipients=("A",)))
+
+    # Anything that changes the preview changes the key.
+    self.assertNotEqual(self.key(), self.key("10.01"))
+    self.assertNotEqual(self.key(), self.key(disabled_recipients=("A",)))
+    self.assertNotEqual(self.key(), self.key(random_seed="2"))
+    key = self.key()
+    self.campaign.save()
+    self.assertNotEqual(self.key(), key)
+
+  def test_cached_response(self):
+    first = self.client.post(self.url, self.preview_fields).content
+    with mock.patch.object(views.ContributionFormView, "post_preview_or_execute") as post_preview_or_execute:
+      self.assertEqual(self.client.post(self.url, dict(self.preview_fields, amount="10")).content, first)
+    post_preview_or_execute.assert_not_called()
+
+class ExportTests(ContributionTestCase):
+  def setUp(self):
+    super(ExportTests, self).setUp()
+    for amount in ("10.00", "30.00"):
+      Contribution.objects.create(campaign=self.campaign, amount=Decimal(amount),
+        contributor={ "email": "test@example.com", "nameFirst": "Test", "nameLast": "Person, Jr." },
+        recipients=[[{ "id": "A", "name": "A", "type": "candidate" }, "%.2f" % (Decimal(amount)/2)],
+                    [{ "id": "B", "name": "B", "type": "candidate" }, "%.2f" % (Decimal(amount)/2)]],
+        transaction={ }, extra={ })
+
+  def test_csv(self):
+    output = io.StringIO()
+    with redirect_stdout(output):
+      call_command("export_contributions", campaign=[self.campaign.id], format="csv", chunk_size=1)
+    rows = list(csv.reader(io.StringIO(output.getvalue())))
+    self.assertEqual(rows[0], EXPORT_COLUMNS)
+    rows = [dict(zip(EXPORT_COLUMNS, row)) for row in rows[1:]]
+    self.assertEqual([(row["contribution_amount"], row["recipient_id"], row["amount"]) for row in rows],
+      [("10.00", "A", "5.00"), ("10.00", "B", "5.00"), ("30.00", "A", "15.00"), ("30.00", "B", "15.00")])
+    self.assertEqual(rows[0]["last_name"], "Person, Jr.")
+
+  def test_admin_export(self):
+    campaign_admin = admin.site._registry[Campaign]
+    response = campaign_admin.export_contributions(None, Campaign.objects.filter(id=self.campaign.id), "jsonl")
+    lines = b"".join(response.streaming_content).decode("utf8").splitlines()
+    self.assertEqual(len(lines), 4)
+    self.assertEqual(json.loads(lines[0])["email"], "test@example.com")
+
+@override_settings(PAYMENT_QUEUE=None, RECEIPT_OUTBOX={ "retry_backoff": 60 })
+class ReceiptOutboxTests(ContributionTestCase):
+  def send_receipts(self):
+    with redirect_stdout(io.StringIO()):
+      call_command("send_receipts", once=True)
+
+  def test_receipt_is_queued_and_sent(self):
+    self.assertEqual(self.post()["status"], "ok")
+    self.assertEqual(len(mail.outbox), 0)
+    self.assertTrue(OutgoingReceipt.objects.exists())
+
+    self.send_receipts()
+    self.assertEqual(len(mail.outbox), 1)
+    self.assertEqual(mail.outbox[0].to, [self.execute_fields["email"]])
+    self.assertFalse(OutgoingReceipt.objects.exists())
+    self.assertIsNotNone(Contribution.objects.get().receipt_sent_at)
+
+  def test_failed_receipt_is_retried_later(self):
+    self.post()
+    with mock.patch.object(views, "send_receipt", side_effect=IOError("Mail server is down.")):
+      self.send_receipts()
+    outgoing_receipt = OutgoingReceipt.objects.get()
+    self.assertEqual(outgoing_receipt.attempts, 1)
+    self.assertEqual(outgoing_receipt.last_error, "Mail server is down.")
+    self.assertGreater(outgoing_receipt.send_after, now() + timedelta(seconds=30))
+    self.assertEqual(Contribution.objects.get().extra["error_sending_receipt"], "Mail server is down.")
+
+    # It isn't ready to send again yet.
+    self.send_receipts()
+    self.assertEqual(len(mail.outbox), 0)
+
+    OutgoingReceipt.objects.update(send_after=now())
+    self.send_receipts()
+    self.assertEqual(len(mail.outbox), 1)
+    self.assertNotIn("error_sending_receipt", Contribution.objects.get().extra)
@@ -1,10 +1,15 @@
 from django.conf.urls import url
 from django.contrib import admin
 
-from . import views
+from . import views, metrics
 
 urlpatterns = [
   url(r'^$', views.ContributionFormView.as_view()),
+  url(r'^visitor-info$', views.visitor_info),
+  url(r'^payment/(?P<key>\w+)$', views.payment_job_status),
   url(r'^test-error-email$', views.test_error_email),
+  url(r'^metrics$', metrics.metrics_view),
   url(r'^admin/', admin.site.urls),
+  # Add any other paths to models.RESERVED_ORGANIZATION_SLUGS.
+  url(r'^(?P<org_slug>[\w-]+)/(?P<campaign_slug>[\w-]+)$', views.ContributionFormView.as_view()),
 ]
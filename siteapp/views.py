@@ -1,16 +1,32 @@
-from django.http import JsonResponse
-from django.shortcuts import render, get_object_or_404
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.db import transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+from django.middleware.csrf import get_token
+from django.utils.cache import patch_cache_control
+from django.views.decorators.cache import never_cache
 from django.views import View
 from django.conf import settings
+from django.core.cache import caches
 from django.utils.timezone import now
+from django.utils.crypto import get_random_string
 
-from .models import alg, Campaign, Contribution
+from .models import alg, Organization, Campaign, Contribution, PaymentJob, OutgoingReceipt, IdempotencyKey
 from .templatetags.site_utils import currency
+from .metrics import Counter, timed
 
 from email_validator import validate_email
 
 import random
-from decimal import Decimal, ROUND_DOWN, ROUND_UP, ROUND_HALF_EVEN, Context as decimalContext, Inexact as decimalInexact
+import hashlib
+import json
+import sys
+import bisect
+import time
+from datetime import timedelta
+from decimal import Decimal, ROUND_DOWN, ROUND_UP, ROUND_HALF_EVEN, Context as decimalContext, Inexact as decimalInexact, DecimalException
 
 from .de import DemocracyEngineAPIClient, DummyDemocracyEngineAPIClient, HumanReadableValidationError
 
@@ -22,6 +38,10 @@ if settings.DE_API:
     settings.DE_API['username'],
     settings.DE_API['password'],
     None,
+    pool_size=settings.DE_API.get('pool_size', 10),
+    keep_alive=settings.DE_API.get('keep_alive', True),
+    meta_cache=caches['default'],
+    meta_cache_ttl=settings.DE_API.get('meta_cache_ttl', 60*60*24),
     )
 else:
   # Testing only, obviously!
@@ -40,41 +60,75 @@ def recipient_sort_key(recip):
 # ]
 
 class ContributionFormView(View):
-  def dispatch(self, request):
-    self.campaign = get_object_or_404(Campaign, id=1, active=True) # also see thank_you
+  # The IdempotencyKey of an execute request, set by post_execute_once.
+  idempotency_key = None
+
+  def dispatch(self, request, org_slug=None, campaign_slug=None):
+    self.campaign = get_campaign(org_slug, campaign_slug)
     return super().dispatch(request)
 
   # Render the form page.
   def get(self, request):
+      # The page is the same for every visitor --- the per-visitor values
+      # come from visitor_info --- and it only changes when the Campaign
+      # or the templates do. Let browsers and caches revalidate their copy
+      # without rendering anything. There's no Last-Modified header because
+      # a date can't reflect a deploy of older template files.
+      etag = '"%s"' % hashlib.sha1(("%d|%s|%s" % (self.campaign.id, self.campaign.updated.isoformat(), LANDING_PAGE_VERSION)).encode("ascii")).hexdigest()
+      if_none_match = request.META.get("HTTP_IF_NONE_MATCH", "")
+      if etag in if_none_match or if_none_match.strip() == "*":
+        response = HttpResponseNotModified()
+      else:
+        # The page is rendered once per Campaign change and kept in memory.
+        cached = landing_page_cache.get(self.campaign.id)
+        if cached is None or cached[0] != self.campaign.updated:
+          cached = (self.campaign.updated, self.render_landing_page())
+          landing_page_cache[self.campaign.id] = cached
+        response = HttpResponse(cached[1])
+
+      response["ETag"] = etag
+      patch_cache_control(response, public=True, max_age=LANDING_PAGE_MAX_AGE)
+      return response
+
+  def render_landing_page(self):
       # Get the contribution limits for the campaign.
       limits = contribution_limits_for_display(
-        compute_minimum_contribution(self.campaign.recipients),
-        compute_maximum_contribution(self.campaign.recipients))
+        get_minimum_contribution(self.campaign),
+        get_maximum_contribution(self.campaign))
 
       # Get the suggested contribution amount from the Campaign but
       # make sure it is within limits.
       suggested_amount = min(max(self.campaign.suggested_amount, limits[0]), limits[1])
 
-      return render(request, 'index.html', {
-        "campaign": self.campaign,
-        "suggested_amount": int(suggested_amount), # suppress cents
-        "min_contrib": limits[0],
-        "max_contrib": limits[1],
-        "recipients": sorted(self.campaign.recipients, key=recipient_sort_key),
-        "recipent_index_half_way": len(self.campaign.recipients)//2,
-        "rstate": random.getrandbits(32), # see split_contribution_to_recipients
-        "random_user_info": Contribution.createRandomContributor(),
-        "SITE_DOMAIN": "if.then.fund",
-        "mixpanel_key": settings.MIXPANEL_KEY,
-      })
+      with timed("render-template"):
+        return render_to_string('index.html', {
+          "campaign": self.campaign,
+          "suggested_amount": int(suggested_amount), # suppress cents
+          "min_contrib": limits[0],
+          "max_contrib": limits[1],
+          "recipients": sorted(self.campaign.recipients, key=recipient_sort_key),
+          "recipent_index_half_way": len(self.campaign.recipients)//2,
+          "SITE_DOMAIN": "if.then.fund",
+          "mixpanel_key": settings.MIXPANEL_KEY,
+        })
 
   # Process the AJAX request on form submission.
   def post(self, request):
+    if request.POST.get("method") == "preview-batch":
+      return self.post_preview_batch(request)
+    if request.POST.get("method") == "execute":
+      if request.POST.get("idempotency-key"):
+        return self.post_execute_once(request)
+    else:
+      return self.post_preview_cached(request)
+    return self.post_preview_or_execute(request)
+
+  def post_preview_or_execute(self, request):
     # Parse just enough of the form to compute the line items
     # for the preview.
 
     try:
-      amount = Decimal(request.POST['amount']).quantize(Decimal('.01'), context=decimalContext(traps=[decimalInexact]))
+      amount = parse_amount(request.POST['amount'])
     except ValueError:
       # Should be client-side validated.
       return JsonResponse({'status': 'invalid', 'message': 'Invalid contribution amount.'})
@@ -85,7 +139,8 @@ class ContributionFormView(View):
     # Get the recipients --- the campaign recipients minus any
     # recipients the user has chosen to suppress.
 
-    filtered_recipients = [r for r in self.campaign.recipients if r["id"] not in request.POST['disabled-recipients'].split(";")]
+    disabled_recipients = request.POST['disabled-recipients'].split(";")
+    filtered_recipients = [r for r in self.campaign.recipients if r["id"] not in disabled_recipients]
 
     # Compute the line items.
 
@@ -93,13 +148,14 @@ class ContributionFormView(View):
       if len(filtered_recipients) == 0:
         raise ValueError("You have removed all recipients.")
 
-      if amount > compute_maximum_contribution(filtered_recipients):
+      if amount > get_maximum_contribution(self.campaign, disabled_recipients):
         # Because recipients can be eliminated, the amount may exceed the
         # maximum that can be distributed to recipients that are included.
         raise ValueError("The contribution amount exceeds the amount that can be distributed to the recipients you selected.")
 
       # Compute line-items.
-      line_items = compute_line_items(filtered_recipients, amount, random_seed)
+      line_items = compute_line_items(filtered_recipients, amount, random_seed,
+        get_line_item_index(self.campaign, disabled_recipients))
     
     except ValueError as e:
       if request.POST.get("method") != "execute":
@@ -129,7 +185,8 @@ class ContributionFormView(View):
     def validate_email2(value):
       try:
         # Validate and return normalized address.
-        return validate_email(value)["email"]
+        with timed("validate-email"):
+          return validate_email(value)["email"]
       except ValueError as e:
         # Add field to exception object and re-raise.
         e.field_name = "email"
@@ -160,43 +217,313 @@ class ContributionFormView(View):
     except ValueError as e:
       return JsonResponse({'status': 'invalid', 'message': str(e), 'field': getattr(e, 'field_name', None)})
 
-    # Execute the transaction.
+    # Before anything can be charged, note on the idempotency key that this
+    # request got this far. See get_idempotent_response.
+    if self.idempotency_key is not None:
+      IdempotencyKey.objects.filter(id=self.idempotency_key.id).update(contribution=contribution)
+
+    # Execute the transaction. If the payment queue is turned on, leave it
+    # for the execute_payments management command so that slow Democracy
+    # Engine calls don't tie up the web workers, and the client will poll
+    # payment_job_status for the result. The card itself is never stored:
+    # it's exchanged for a Democracy Engine token first, and the job holds
+    # the token until it is finished. So the request still waits on that
+    # one Democracy Engine call, just not on the charge.
+    if settings.PAYMENT_QUEUE:
+      try:
+        token = tokenize_payment(contribution, request.POST)
+      except Exception as e:
+        # Nothing was charged, so the user can correct the card and try
+        # again.
+        contribution.delete()
+        if isinstance(e, HumanReadableValidationError):
+          return JsonResponse({'status': 'invalid', 'message': str(e)})
+        return JsonResponse({'status': 'invalid', 'message': 'There was a problem processing your card. Please try again in a few minutes.'})
+      job = PaymentJob.objects.create(
+        key=get_random_string(32),
+        contribution=contribution,
+        payment={ "token": token },
+        result={},
+      )
+      return JsonResponse({'status': 'queued', 'job': job.key})
+
+    return JsonResponse(process_contribution(contribution, request.POST))
 
+  # Previews are determined by the Campaign's recipients, the amount, the
+  # disabled recipients, and the random seed, so users going back and forth
+  # between amounts or toggling recipients often ask for the same preview
+  # again. Keep the responses in the shared cache so a repeat costs a single
+  # cache get.
+  def post_preview_cached(self, request):
+    from django.core.cache import cache
     try:
-      execute_contribution(contribution, request.POST)
-    
-    except HumanReadableValidationError as e:
-      # Credit card or other validation failed. Since we can
-      # tell the user what happened, we can delete the Contribution
-      # record.
-      contribution.delete()
+      amount = parse_amount(request.POST.get('amount', ''))
+    except ValueError:
+      # Invalid amounts are not cached.
+      return self.post_preview_or_execute(request)
+
+    cache_key = get_preview_cache_key(self.campaign, amount,
+      request.POST.get('disabled-recipients', '').split(";"), request.POST.get('rstate', ''))
+    content = cache.get(cache_key)
+    if content is not None:
+      preview_cache_requests.inc(result="hit")
+      return HttpResponse(content, content_type="application/json")
+
+    preview_cache_requests.inc(result="miss")
+    response = self.post_preview_or_execute(request)
+    if response.status_code == 200:
+      cache.set(cache_key, response.content, PREVIEW_CACHE_TIMEOUT)
+    return response
+
+  # Process an execute request at most once for each idempotency key that
+  # the form sends with it, so that a double-click or a retried request
+  # doesn't charge the user twice. Later requests with the same key get
+  # the response to the first one, or a "pending" status while it is still
+  # being processed, in which case the form submits again a moment later.
+  def post_execute_once(self, request):
+    key = request.POST["idempotency-key"]
+    if len(key) > 64:
+      return JsonResponse({'status': 'invalid', 'message': 'Invalid request.'})
+
+    while True:
+      try:
+        with transaction.atomic():
+          record = IdempotencyKey.objects.create(key=key, campaign=self.campaign)
+        self.idempotency_key = record
+        break
+      except IntegrityError:
+        pass
+
+      # A request with this key was already made.
+      response = get_idempotent_response(key, self.campaign)
+      if response is not None:
+        return JsonResponse(response)
+      # The first request failed validation and its key was released.
+      # Process this one.
+
+    # (The record is updated with filter() in case a later request took
+    # over the key. See get_idempotent_response.)
+    try:
+      response = self.post_preview_or_execute(request)
+    except:
+      IdempotencyKey.objects.filter(id=record.id, response=None).delete()
+      raise
+
+    result = json.loads(response.content.decode("utf8"))
+    if result.get("status") == "invalid":
+      # Nothing was charged, so release the key so that the user can
+      # correct the form and submit it again.
+      IdempotencyKey.objects.filter(id=record.id, response=None).delete()
+    else:
+      IdempotencyKey.objects.filter(id=record.id).update(response=result)
+    return response
+
+  # Process the AJAX request for the line items of many contribution
+  # amounts at once, so that the page can prefetch the line items for
+  # common amounts rather than making a request for each one.
+  def post_preview_batch(self, request):
+    try:
+      amounts = parse_preview_batch_amounts(request.POST)
+    except ValueError as e:
       return JsonResponse({'status': 'invalid', 'message': str(e)})
-    
-    except Exception as e:
-      # Other errors are unreportable. We'll pretend it went fine
-      # and will sort this out later. But we won't send a receipt.
+
+    random_seed = request.POST['rstate']
+
+    disabled_recipients = request.POST['disabled-recipients'].split(";")
+    filtered_recipients = [r for r in self.campaign.recipients if r["id"] not in disabled_recipients]
+
+    # If the limits can't be computed for the remaining recipients, every
+    # amount gets the same response as an amount over the limits.
+    maximum_contribution = None
+    try:
+      if len(filtered_recipients) > 0:
+        maximum_contribution = get_maximum_contribution(self.campaign, disabled_recipients)
+        index = get_line_item_index(self.campaign, disabled_recipients)
+    except (ValueError, AssertionError):
+      maximum_contribution = None
+
+    # Compute the line items for each amount. To keep the response small,
+    # identify recipients by ID only.
+    line_items_by_amount = { }
+    for amount in amounts:
+      try:
+        if maximum_contribution is None or amount > maximum_contribution:
+          raise ValueError()
+        line_items = [
+          (line_item[0]["id"], currency(line_item[1], hide_zero_cents=False))
+          for line_item in compute_line_items(filtered_recipients, amount, random_seed, index)
+        ]
+      except ValueError:
+        # Same as for a single preview above.
+        line_items = [(recip["id"], "limits exceeded") for recip in filtered_recipients]
+      line_items_by_amount[str(amount)] = line_items
+
+    return JsonResponse({ 'line_items': line_items_by_amount })
+
+# Active Campaigns by (Organization slug, Campaign slug), kept in memory so
+# that finding the Campaign for a request doesn't usually hit the database.
+# The cache is cleared when any Campaign or Organization is saved or
+# deleted: in this process directly, and in other processes by way of a
+# version string in the shared cache that is checked on each lookup. The
+# default cache isn't shared between processes, though, so entries are also
+# only used for CAMPAIGN_CACHE_TTL seconds after they are loaded.
+campaign_cache = { }
+campaign_cache_version = None
+CAMPAIGN_CACHE_TTL = 10
+
+def get_campaign(org_slug, campaign_slug):
+  global campaign_cache_version
+  from django.core.cache import cache
+  version = cache.get("campaign_cache_version")
+  if version != campaign_cache_version:
+    campaign_cache.clear()
+    campaign_cache_version = version
+
+  key = (org_slug, campaign_slug)
+  campaign, loaded_at = campaign_cache.get(key, (None, None))
+  if campaign is None or loaded_at < time.time() - CAMPAIGN_CACHE_TTL:
+    if org_slug is None:
+      # The site root is the first Campaign, for links from before
+      # Campaigns had their own URLs.
+      campaigns = Campaign.objects.filter(id=1)
+    else:
+      campaigns = Campaign.objects.filter(owner__slug=org_slug, slug=campaign_slug)
+    campaign = campaigns.filter(active=True).select_related('owner').order_by('id').first()
+    if campaign is None:
+      campaign_cache.pop(key, None)
+      raise Http404()
+    campaign_cache[key] = (campaign, time.time())
+  return campaign
+
+@receiver(post_save, sender=Campaign)
+@receiver(post_delete, sender=Campaign)
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def invalidate_campaign_cache(sender, **kwargs):
+  from django.core.cache import cache
+  campaign_cache.clear()
+  cache.set("campaign_cache_version", get_random_string(12), None)
+
+# Rendered form pages for each Campaign, as (Campaign.updated, HTML).
+# See ContributionFormView.render_landing_page.
+landing_page_cache = { }
+
+def get_landing_page_version():
+  # A hash of the templates the form page is rendered from, which changes
+  # when a deploy changes any of them. It's of their contents rather than
+  # their modification times so that it's the same on every server.
+  import os.path
+  h = hashlib.sha1()
+  for template_dir in settings.TEMPLATES[0]['DIRS']:
+    for dirpath, dirnames, filenames in sorted(os.walk(template_dir)):
+      for fn in sorted(filenames):
+        path = os.path.join(dirpath, fn)
+        h.update(os.path.relpath(path, template_dir).encode("utf8"))
+        with open(path, "rb") as f:
+          h.update(f.read())
+  return h.hexdigest()
+LANDING_PAGE_VERSION = get_landing_page_version()
+
+# How long, in seconds, nginx and browsers may use the form page before
+# revalidating it. It's kept short so that Campaign changes show up quickly.
+LANDING_PAGE_MAX_AGE = 1
+
+@never_cache
+def visitor_info(request):
+  # The values on the form page that differ for each visitor, which are
+  # fetched separately so that the page itself can be cached.
+  return JsonResponse({
+    "rstate": random.getrandbits(32), # see split_contribution_to_recipients
+    "random_user_info": Contribution.createRandomContributor(),
+    "csrf_token": get_token(request),
+  })
+
+# How long, in seconds, after the first request with an idempotency key
+# started, a later request with the key can be sure that it is no longer
+# running. uwsgi kills requests after REQUEST_TIME_LIMIT seconds, and the
+# extra minute allows for clock differences between servers.
+IDEMPOTENT_REQUEST_TIMEOUT = settings.REQUEST_TIME_LIMIT + 60
+
+def get_idempotent_response(key, campaign):
+  # Return the response to the first request made with an idempotency key,
+  # a "pending" status if it is still being processed, or None if the key
+  # has been released.
+  record = IdempotencyKey.objects.filter(key=key).only('campaign_id', 'contribution_id', 'response', 'created').first()
+  if record is None:
+    return None
+  if record.campaign_id != campaign.id:
+    return {'status': 'invalid', 'message': 'Please reload the page and try again.'}
+  if record.response is not None:
+    return record.response
+  if record.created >= now() - timedelta(seconds=IDEMPOTENT_REQUEST_TIMEOUT):
+    # The first request may still be running.
+    return {'status': 'pending'}
+
+  # The first request was killed before it finished.
+  if record.contribution_id is None:
+    # It didn't get as far as creating a Contribution, so nothing was
+    # charged. Release the key so that this request is processed instead.
+    IdempotencyKey.objects.filter(id=record.id, response=None).delete()
+    return None
+
+  # The card may or may not have been charged, so never execute the
+  # Contribution again. Like other unreportable errors in
+  # process_contribution, the error is recorded on the Contribution to be
+  # sorted out by hand and the user is told it went fine. But if it was
+  # queued, the payment job will finish it.
+  job = PaymentJob.objects.filter(contribution_id=record.contribution_id).only('key').first()
+  if job is not None:
+    response = {'status': 'queued', 'job': job.key}
+  else:
+    contribution = Contribution.objects.filter(id=record.contribution_id).first()
+    if contribution is not None and not contribution.transaction:
       contribution.transaction = {
         "error": {
-          "message": str(e),
-          "type": str(type(e)),
+          "message": "The request executing this contribution stopped before it finished.",
+          "type": "IdempotencyKey",
         }
       }
       contribution.save(update_fields=['transaction'])
-    
-    else:
-      # No problems. Send a receipt.
-      try:
-        send_receipt(contribution)
-      except Exception as e:
-        # Catch all exceptions - just record that one ocurred.
-        contribution.extra["error_sending_receipt"] = str(e)
-        contribution.save(update_fields=['extra'])
-
-    # Return OK - the client will redirect to the thanks page.
-
-    return JsonResponse({'status': 'ok'})
-
-def compute_minimum_contribution(recipients):
+    response = {'status': 'ok'}
+  IdempotencyKey.objects.filter(id=record.id).update(response=response)
+  return response
+
+# The most amounts that can be previewed in a single request.
+MAX_PREVIEW_BATCH_AMOUNTS = 100
+
+def parse_amount(value):
+  # Parse a contribution amount, which must be a whole number of cents.
+  # Decimal also parses "NaN" and "Infinity", which aren't amounts.
+  try:
+    d = Decimal(value)
+    if not d.is_finite():
+      raise ValueError("Invalid contribution amount.")
+    return d.quantize(Decimal('.01'), context=decimalContext(traps=[decimalInexact]))
+  except DecimalException:
+    raise ValueError("Invalid contribution amount.")
+
+def parse_preview_batch_amounts(postdata):
+  # The amounts to preview are given either as a semicolon-separated
+  # list or as a range from amount_start to amount_stop, inclusive,
+  # in increments of amount_step.
+  if postdata.get("amounts"):
+    amounts = [parse_amount(value) for value in postdata["amounts"].split(";")]
+  else:
+    start, stop, step = (
+      to_cents(parse_amount(postdata.get(field, "")))
+      for field in ("amount_start", "amount_stop", "amount_step"))
+    if step <= 0:
+      raise ValueError("Invalid contribution amount step.")
+    # Check the size before making the list.
+    if stop >= start and (stop - start) // step >= MAX_PREVIEW_BATCH_AMOUNTS:
+      raise ValueError("Too many contribution amounts.")
+    amounts = [from_cents(cents) for cents in range(start, stop + 1, step)]
+
+  if len(amounts) > MAX_PREVIEW_BATCH_AMOUNTS:
+    raise ValueError("Too many contribution amounts.")
+  return amounts
+
+def compute_minimum_contribution(recipients, index=None):
   # The minimum contribution is 50 cents to the receipient with the
   # lowest points, then proportional amounts to the remaining recipients,
   # rounded up. It must be at least min_contrib. We use 50 cents and not
@@ -211,7 +538,7 @@ def compute_minimum_contribution(recipients):
     )
 
   # sanity check that line items are computable
-  assert compute_line_items(recipients, min_contribution, None)
+  assert compute_line_items(recipients, min_contribution, None, index)
 
   return min_contribution
 
@@ -221,7 +548,7 @@ def get_recipient_limit(recipient):
     r = min(r, recipient["limit"])
   return r
 
-def compute_maximum_contribution(recipients):
+def compute_maximum_contribution(recipients, index=None):
   # The maximum contribution is the sum of the contribution limits
   # for each recipient and all overflow recipients. It must not
   # exceed 'max_contrib'.
@@ -230,12 +557,95 @@ def compute_maximum_contribution(recipients):
     sum(get_recipient_limit(recip) for recip in recipients)
     )
 
-  # sanity check that line items are computable
-  assert compute_line_items(recipients, maximum_contribution, None)
+  # Check that the maximum can actually be split among the recipients.
+  # compute_line_items raises ValueError if it can't. (Not with assert,
+  # which python -O skips.)
+  compute_line_items(recipients, maximum_contribution, None, index)
 
   return maximum_contribution
 
 
+def get_minimum_contribution(campaign, disabled_recipients=()):
+  # Computing the limits runs compute_line_items as a sanity check,
+  # so cache them.
+  return get_campaign_cached(campaign, disabled_recipients, "min_contrib",
+    lambda recipients : compute_minimum_contribution(recipients, get_line_item_index(campaign, disabled_recipients)))
+
+def get_maximum_contribution(campaign, disabled_recipients=()):
+  return get_campaign_cached(campaign, disabled_recipients, "max_contrib",
+    lambda recipients : compute_maximum_contribution(recipients, get_line_item_index(campaign, disabled_recipients)))
+
+def get_line_item_index(campaign, disabled_recipients=()):
+  # Get the LineItemIndex to pass to compute_line_items for the Campaign's
+  # recipients minus the disabled recipients. The version in the name is
+  # bumped when LineItemIndex changes so that old copies in the cache
+  # aren't used.
+  return get_campaign_cached(campaign, disabled_recipients, "line_item_index_v2", LineItemIndex)
+
+# Values from get_campaign_cached that this process has already loaded,
+# by cache key, so that they aren't unpickled from the cache on every
+# request. Keys for old Campaign versions and rarely used sets of disabled
+# recipients pile up, so it's emptied when it gets big.
+campaign_cached_values = { }
+MAX_CAMPAIGN_CACHED_VALUES = 1000
+
+def get_campaign_cached(campaign, disabled_recipients, name, compute_func):
+  # Memoize something computed from a Campaign's recipients minus the
+  # recipients the user has disabled in the Django cache, which is shared
+  # across workers. compute_func is called with that list of recipients.
+  # Campaign.updated changes whenever the Campaign (and so possibly its
+  # recipients) is saved, so including it in the key evicts old entries,
+  # which then just expire.
+  from django.core.cache import cache
+
+  disabled_recipients = normalize_disabled_recipients(campaign, disabled_recipients)
+
+  cache_key = "campaign:%s:%d:%s:%s" % (
+    name,
+    campaign.id,
+    campaign.updated.isoformat(),
+    hashlib.sha1(";".join(disabled_recipients).encode("utf8")).hexdigest(),
+  )
+  value = campaign_cached_values.get(cache_key)
+  if value is not None:
+    return value
+  value = cache.get(cache_key)
+  if value is None:
+    value = compute_func([r for r in campaign.recipients if r["id"] not in disabled_recipients])
+    cache.set(cache_key, value)
+  if len(campaign_cached_values) >= MAX_CAMPAIGN_CACHED_VALUES:
+    campaign_cached_values.clear()
+  campaign_cached_values[cache_key] = value
+  return value
+
+def normalize_disabled_recipients(campaign, disabled_recipients):
+  # Normalize the disabled recipients so that equivalent requests share a
+  # cache entry and unknown IDs in the request don't make new ones.
+  campaign_recipient_ids = set(r["id"] for r in campaign.recipients)
+  return sorted(set(disabled_recipients) & campaign_recipient_ids)
+
+# How long, in seconds, to keep preview responses in the cache. Each
+# visitor gets their own random seed, so entries are only useful while
+# that visitor is on the page. Entries for a Campaign are also abandoned
+# when it is saved, like in get_campaign_cached.
+PREVIEW_CACHE_TIMEOUT = 30*60
+
+preview_cache_requests = Counter("newco_preview_cache_requests_total", "Preview requests by whether the response was in the cache (hit or miss).")
+
+def get_preview_cache_key(campaign, amount, disabled_recipients, random_seed):
+  # The amount is parsed and the disabled recipients are normalized so
+  # that equivalent requests share an entry. The key is hashed to keep it
+  # within memcached's key length limit.
+  return "campaign:preview:%d:%s" % (
+    campaign.id,
+    hashlib.sha1("\n".join([
+      campaign.updated.isoformat(),
+      str(amount),
+      ";".join(normalize_disabled_recipients(campaign, disabled_recipients)),
+      random_seed,
+    ]).encode("utf8")).hexdigest(),
+  )
+
 def contribution_limits_for_display(min_contrib, max_contrib):
   # Adjust the limits for display purposes.
 
@@ -254,15 +664,19 @@ def contribution_limits_for_display(min_contrib, max_contrib):
   return (min_contrib, max_contrib)
 
 
-def compute_line_items(recipients, amount, random_seed):
-  # Split the amount to the recipients that have 'points' fields.
-  line_items = split_contribution_to_recipients(
-    [recip for recip in recipients if "points" in recip],
-    amount,
-    random_seed)
+def compute_line_items(recipients, amount, random_seed, index=None):
+  # Everything about the recipients that doesn't depend on the amount is
+  # in a LineItemIndex, which callers can get from get_line_item_index
+  # so that it isn't recomputed for each call.
+  if index is None:
+    index = LineItemIndex(recipients)
+
+  # Split the amount to the recipients that have 'points' fields. Line
+  # items refer to recipients by position until the end.
+  line_items = index.split(recipients, amount, random_seed)
 
   # Send the rest to overflow recipients.
-  overflow_recipients = [recip for recip in recipients if "points" not in recip]
+  overflow_recipients = list(index.overflow_recipients)
   while True:
     # How much remains?
     remaining = amount - sum(line_item[1] for line_item in line_items)
@@ -275,100 +689,263 @@ def compute_line_items(recipients, amount, random_seed):
 
     # Add a line item for the next overflow recipient. The recipient
     # may have a limit.
-    recip = overflow_recipients.pop(0)
-    line_items.append( (recip, min(remaining, get_recipient_limit(recip)) ) )
+    i = overflow_recipients.pop(0)
+    line_items.append( (i, min(remaining, get_recipient_limit(recipients[i])) ) )
 
   # Sanity check.
   assert amount == sum(line_item[1] for line_item in line_items)
 
-  # Sort.
-  line_items.sort(key = lambda line_item : recipient_sort_key(line_item[0]))
-
-  return line_items
-
+  # Sort. The sort is stable, so this is the same as sorting by
+  # recipient_sort_key.
+  line_items.sort(key = lambda line_item : index.sort_rank[line_item[0]])
+
+  return [(recipients[i], recip_amount) for i, recip_amount in line_items]
+
+
+class LineItemIndex(object):
+  """Precomputed breakpoints for splitting contributions among a list of recipients."""
+
+  # Contributions are split among the recipients with "points" fields,
+  # with each recipient getting an amount proportional to its points
+  # until limits are hit, and the rest goes to the overflow recipients.
+  #
+  # All of the arithmetic is done in integer cents. Each point is "worth"
+  # amount/total_points, rounded down to the cent. If any recipient's
+  # share exceeds its limit, its amount is fixed (both in the sense of
+  # "correct" its amount and also "make static" its amount) at the limit
+  # and what remains is re-apportioned among the other recipients, which
+  # may in turn push more recipients over their limits. Since the worth
+  # of a point only goes up as recipients are fixed, recipients hit their
+  # limits in order of (limit + 1 cent)/points, and for any number k the
+  # first k recipients in that order are fixed exactly when the amount is
+  # at least some breakpoint. So for a given list of recipients, we sort
+  # them once and compute the breakpoints, and then the recipients fixed
+  # at any amount are found by a binary search.
+  #
+  # Only numbers are stored here, and recipients are referred to by
+  # their position in the list of recipients, so that this is cheap to
+  # put in the cache.
+
+  def __init__(self, recipients):
+    type_limits = { recip_type: to_cents(limit) for recip_type, limit in alg["limits"].items() }
+
+    # The positions of the recipients with points and the overflow recipients.
+    self.points_recipients = [i for i, recip in enumerate(recipients) if "points" in recip]
+    self.overflow_recipients = [i for i, recip in enumerate(recipients) if "points" not in recip]
+
+    # The points and limits of the recipients with points, in cents. The
+    # proportional split is limited by the limit for the recipient's type,
+    # but the recipient's own limit, if lower, limits how many leftover
+    # pennies it can take.
+    self.points = [int(recipients[i]["points"]) for i in self.points_recipients]
+    self.limits = [type_limits[recipients[i]["type"]] for i in self.points_recipients]
+    self.penny_limits = [
+      min(type_limits[recipients[i]["type"]], to_cents(recipients[i]["limit"]))
+        if "limit" in recipients[i] else type_limits[recipients[i]["type"]]
+      for i in self.points_recipients
+    ]
+    self.total_points = sum(self.points)
+
+    # Sort the recipients in the order they hit their limits. A recipient's
+    # rounded-down share amount*p/total_points exceeds its limit exactly
+    # when amount*p >= (limit+1)*total_points. (Sorting on floats is exact
+    # here: distinct ratios of cents to points differ by far more than
+    # float rounding.)
+    self.order = sorted(range(len(self.points_recipients)), key=lambda i : (self.limits[i] + 1) / self.points[i])
+
+    # For each k, the total limits and points of the first k recipients
+    # in that order, and the amount at which the k+1'th recipient is
+    # fixed at its limit once the first k are. The first k recipients
+    # are fixed when the amount is at least all of the first k of those
+    # amounts, so keep the running maximum.
+    self.fixed_amounts = [0]
+    self.fixed_points = [0]
+    self.breakpoints = []
+    for i in self.order:
+      free_points = self.total_points - self.fixed_points[-1]
+      breakpoint = self.fixed_amounts[-1] + ceil_div((self.limits[i] + 1) * free_points, self.points[i])
+      self.breakpoints.append(max(breakpoint, self.breakpoints[-1]) if self.breakpoints else breakpoint)
+      self.fixed_amounts.append(self.fixed_amounts[-1] + self.limits[i])
+      self.fixed_points.append(self.fixed_points[-1] + self.points[i])
+
+    # Sorting line items by these ranks, stably, is the same as sorting
+    # them by recipient_sort_key.
+    self.sort_rank = [None] * len(recipients)
+    rank = -1
+    prev_key = None
+    for i in sorted(range(len(recipients)), key=lambda i : recipient_sort_key(recipients[i])):
+      key = recipient_sort_key(recipients[i])
+      if key != prev_key:
+        rank += 1
+        prev_key = key
+      self.sort_rank[i] = rank
+
+  def split(self, recipients, amount, random_seed):
+    # Split a contribution among the recipients with points. Returns a list
+    # of (position in recipients, amount) tuples.
+
+    if len(self.points_recipients) == 0:
+      return []
+
+    amount = to_cents(amount)
+
+    # Every recipient must get at least a cent. Shares only go up as other
+    # recipients are fixed at their limits, so it's enough to check the
+    # initial apportionment.
+    if amount * min(self.points) // self.total_points < 1:
+      raise ValueError("The amount is too small.")
 
-def split_contribution_to_recipients(recipients, amount, random_seed):
-  # Split a contribution among recipients, with each recipient
-  # getting an amount proportional to their "points", until
-  # limits are hit.
+    # How many recipients are fixed at their limits at this amount?
+    num_fixed = bisect.bisect_right(self.breakpoints, amount)
+
+    # Recipients are fixed in rounds --- all of the recipients over their
+    # limits at the current apportionment at once, and then the apportionment
+    # is recomputed --- and fixed line items are ordered by round so that they
+    # come out in the same order as when this was computed recursively. Each
+    # round is the run of recipients in order whose limits are exceeded
+    # at the apportionment after the previous round.
+    fixed = []
+    start = 0
+    while start < num_fixed:
+      remaining = amount - self.fixed_amounts[start]
+      free_points = self.total_points - self.fixed_points[start]
+      lo, hi = start + 1, num_fixed # the first recipient in order is always fixed
+      while lo < hi:
+        mid = (lo + hi) // 2
+        i = self.order[mid]
+        if remaining * self.points[i] >= (self.limits[i] + 1) * free_points:
+          lo = mid + 1
+        else:
+          hi = mid
+      fixed.extend(sorted(self.order[start:lo]))
+      start = lo
+
+    # Apportion what remains to the recipients that did not hit limits, in
+    # their original order.
+    amount -= self.fixed_amounts[num_fixed]
+    total_points = self.total_points - self.fixed_points[num_fixed]
+    fixed_indexes = set(fixed)
+    free = [i for i in range(len(self.points_recipients)) if i not in fixed_indexes]
+    free_amounts = [amount * self.points[i] // total_points for i in free]
+
+    if len(free) > 0:
+      # Each recipient got a certain number of cents, with rounding down. That
+      # often leaves some cents remaining. Distribute those cents randomly to
+      # any recipients that can take it.
+
+      # Shuffle the recipients that can take some extra pennies. Seed the PRNG
+      # with the given value so that the distribution is stable across calls,
+      # so that whatever we show the user as a preview is what sticks at
+      # submission. Use a PRNG of our own rather than the module-level one so
+      # that concurrent calls in other threads can't disturb its state. (It
+      # produces the same shuffle as seeding the module-level PRNG would.)
+      rng = random.Random(random_seed)
+      dist_recipients = list(range(len(free)))
+      rng.shuffle(dist_recipients)
+
+      # Recipients with a "limit" field of their own may not have room for
+      # any more pennies. skip[j] points toward the next position in
+      # dist_recipients at or after j whose recipient has room. Position
+      # len(dist_recipients) is a sentinel meaning no one after j has room.
+      skip = list(range(len(dist_recipients) + 1))
+      def has_room(j):
+        line_item_index = dist_recipients[j]
+        return self.penny_limits[free[line_item_index]] > free_amounts[line_item_index]
+      def next_with_room(j):
+        root = j
+        while skip[root] != root:
+          root = skip[root]
+        while skip[j] != root:
+          skip[j], j = root, skip[j]
+        return root
+      for j in range(len(dist_recipients)):
+        if not has_room(j):
+          skip[j] = j + 1
+
+      # For each cent that needs to be put somewhere, give it to the next
+      # recipient in the shuffled order with room for an extra penny, looking
+      # first from the cent's position in the order and then wrapping around.
+      remaining_amount = amount - sum(free_amounts)
+      for rnext in range(remaining_amount):
+        j = next_with_room(rnext % len(dist_recipients))
+        if j == len(dist_recipients):
+          j = next_with_room(0)
+          if j == len(dist_recipients):
+            # No one has room for a penny. Can't distribute any more.
+            break
+
+        # Add a penny to this recipient.
+        free_amounts[dist_recipients[j]] += 1
+        if not has_room(j):
+          skip[j] = j + 1
+
+    # Recipients that hit their limits get exactly the limit.
+    return [
+      (self.points_recipients[i], alg["limits"][recipients[self.points_recipients[i]]["type"]])
+      for i in fixed
+    ] + [
+      (self.points_recipients[i], from_cents(free_amount))
+      for i, free_amount in zip(free, free_amounts)
+    ]
 
-  # recursive base case
-  if len(recipients) == 0:
-    return []
+def round_to_cents(amount, rounding_type):
+  return amount.quantize(Decimal('.01'), rounding=rounding_type)
 
-  # The recipients all have "points" to allow for some recipients to
-  # receive more of the contribution than others. Each point is "worth"
-  # amount/total_points.
-  total_points = sum(Decimal(recip["points"]) for recip in recipients)
+def to_cents(amount):
+  # Convert a dollar amount to an integer number of cents.
+  return int(round_to_cents(Decimal(amount), ROUND_DOWN) * 100)
 
-  # Compute the apportionment based on the points.
-  fixed_line_items = []
-  free_line_items = []
-  for recip in recipients:
-    recip_amount = round_to_cents(amount * recip["points"] / total_points, ROUND_DOWN)
+def ceil_div(a, b):
+  # Integer division, rounding up.
+  return -(-a // b)
 
-    if recip_amount < Decimal("0.01"):
-      raise ValueError("The amount is too small.")
+def from_cents(cents):
+  # Convert an integer number of cents to a dollar amount with
+  # exactly two decimal places.
+  return Decimal(cents).scaleb(-2)
 
-    # But there are contribution limits. If any recipient exceeds its
-    # limit, then fix its amount (both in the sense of "correct" its
-    # amount and also "make static" its amount).
-    if recip_amount > alg["limits"][recip["type"]]:
-      # Set the amount to the limit.
-      fixed_line_items.append( (recip, alg["limits"][recip["type"]]) )
-    else:
-      # Record the proportional amount.
-      free_line_items.append( (recip, recip_amount) )
-
-  # If no recipient exceeded limits, return them as-is.
-  if len(fixed_line_items) == 0:
-    # Each recipient got a certain number of cents, with rounding down. That
-    # often leaves some cents remaining. Distribute those cents randomly to
-    # any recipients that can take it.
-
-    # Shuffle the recipients that can take some extra pennies. Seed the PRNG
-    # with the given value so that the distribution is stable across calls,
-    # so that whatever we show the user as a preview is what sticks at
-    # submission.
-    random.seed(random_seed)
-    dist_recipients = list(range(len(free_line_items)))
-    random.shuffle(dist_recipients)
-
-    # For each cent that needs to be put somewhere...
-    remaining_amount = amount - sum(line_item[1] for line_item in free_line_items)
-    rnext = 0
-    for _ in range(int(remaining_amount*100)):
-      # Who is the next recipient with room for an extra penny?
-      for i in range(len(dist_recipients)):
-        line_item_index = dist_recipients[(rnext + i) % len(dist_recipients)]
-        if get_recipient_limit(free_line_items[line_item_index][0]) > free_line_items[line_item_index][1]:
-          # Has room for a penny.
-          break
-      else:
-        # No one has room for a penny. Can't distribute any more.
-        break
-
-      # Add a penny to this recipient and advance to the next recipient for the next iteration.
-      free_line_items[line_item_index] = (free_line_items[line_item_index][0], free_line_items[line_item_index][1]+Decimal("0.01"))
-      rnext += 1
+def execute_contribution(contribution, cc_postdata):
+  # Create the Democracy Engine API donation request. cc_postdata is
+  # either the card fields from the form or a token from tokenize_payment.
+  req = create_donation_request(contribution)
+  req.update(get_payment_fields(cc_postdata))
 
-    return free_line_items
+  with timed("create-donation"):
+    resp = DemocracyEngineAPI.create_donation(req)
 
-  # Since some recipients exceeded limits, re-apportion the overflow
-  # to the remaining recipients by calling this function recursively
-  # on the recipients that did not exceed limits, with the contribution
-  # amount that remains after taking into account the ones that did
-  # exceed limits.
-  remaining_recipients = [line_item[0] for line_item in free_line_items]
-  remaining_amount = amount - sum(line_item[1] for line_item in fixed_line_items)
-  return fixed_line_items + split_contribution_to_recipients(remaining_recipients, remaining_amount, random_seed)
+  contribution.transaction = resp
+  contribution.save(update_fields=['transaction'])
 
-def round_to_cents(amount, rounding_type):
-  return amount.quantize(Decimal('.01'), rounding=rounding_type)
+def tokenize_payment(contribution, cc_postdata):
+  # Exchange the card fields from the form for a Democracy Engine token
+  # that can be charged later, with an authorization test for the
+  # contribution but no charge. Raises HumanReadableValidationError if
+  # the card is declined. This is made while the user waits, so use the
+  # shorter timeout for live requests. Nothing is charged if it times out.
+  req = create_donation_request(contribution)
+  req.update(get_payment_fields(cc_postdata))
+  req.update({
+    "authtest_request": True,
+    "token_request": True,
+  })
+  with timed("tokenize-payment"):
+    resp = DemocracyEngineAPI.create_donation(req, live_request=True)
+  return resp["token"]
+
+def get_payment_fields(cc_postdata):
+  if "token" in cc_postdata:
+    return { "token": cc_postdata["token"] }
+  return {
+    "cc_number": cc_postdata['ccNum'].replace(" ", ""),
+    "cc_month": cc_postdata['ccExpMonth'],
+    "cc_year": cc_postdata['ccExpYear'],
+    "cc_verification_value": cc_postdata['ccCVV'],
+  }
 
-def execute_contribution(contribution, cc_postdata):
-  # Create the Democracy Engine API donation request.
-  req = {
+def create_donation_request(contribution):
+  # The fields of a Democracy Engine API donation request other than
+  # the payment fields.
+  return {
     "donor_first_name": contribution.contributor['nameFirst'],
     "donor_last_name": contribution.contributor['nameLast'],
     "donor_address1": contribution.contributor['address'],
@@ -394,17 +971,13 @@ def execute_contribution(contribution, cc_postdata):
     "cc_last_name": contribution.contributor['nameLast'],
     "cc_zip": contribution.contributor['zip'],
 
-    # billing details
-    "cc_number": cc_postdata['ccNum'].replace(" ", ""),
-    "cc_month": cc_postdata['ccExpMonth'],
-    "cc_year": cc_postdata['ccExpYear'],
-    "cc_verification_value": cc_postdata['ccCVV'],
-
-    # line items
+    # line items (if the Contribution was loaded from the database, as
+    # by the payment queue, the amounts have been through JSON and are
+    # no longer Decimals)
     "line_items": [
       {
         "recipient_id": line_item[0]["de_recipient_id"],
-        "amount": DemocracyEngineAPI.format_decimal(line_item[1]),
+        "amount": DemocracyEngineAPI.format_decimal(Decimal(str(line_item[1]))),
       }
       for line_item in contribution.recipients
     ],
@@ -421,25 +994,153 @@ def execute_contribution(contribution, cc_postdata):
     },
   }
 
-  resp = DemocracyEngineAPI.create_donation(req)
+def process_contribution(contribution, cc_postdata, can_retry=lambda e : False):
+  # Execute the transaction for a new Contribution and send a receipt,
+  # and return the response to give the user. If execution raises an
+  # exception for which can_retry returns True, the exception is
+  # re-raised so that the caller can try again later.
+
+  try:
+    execute_contribution(contribution, cc_postdata)
+  
+  except HumanReadableValidationError as e:
+    # Credit card or other validation failed. Since we can
+    # tell the user what happened, we can delete the Contribution
+    # record.
+    contribution.delete()
+    return {'status': 'invalid', 'message': str(e)}
+  
+  except Exception as e:
+    if can_retry(e):
+      raise
+
+    # Other errors are unreportable. We'll pretend it went fine
+    # and will sort this out later. But we won't send a receipt.
+    contribution.transaction = {
+      "error": {
+        "message": str(e),
+        "type": str(type(e)),
+      }
+    }
+    contribution.save(update_fields=['transaction'])
+  
+  else:
+    # No problems. Send a receipt. If the receipt outbox is turned on,
+    # leave it for the send_receipts management command so that the user
+    # doesn't wait on the mail server.
+    if settings.RECEIPT_OUTBOX:
+      OutgoingReceipt.objects.create(contribution=contribution)
+    else:
+      try:
+        send_receipt(contribution)
+      except Exception as e:
+        # Catch all exceptions - just record that one ocurred.
+        contribution.extra["error_sending_receipt"] = str(e)
+        contribution.save(update_fields=['extra'])
 
-  contribution.transaction = resp
-  contribution.save(update_fields=['transaction'])
+  # Return OK - the client will redirect to the thanks page.
+
+  return {'status': 'ok'}
+
+def run_payment_job(job):
+  # Run a PaymentJob that a worker has claimed.
+
+  from requests.exceptions import ConnectTimeout
+
+  # Only retry when we could not connect to Democracy Engine at all. Any
+  # other failure might have happened after the card was charged.
+  def can_retry(e):
+    return isinstance(e, ConnectTimeout) \
+      and job.attempts < settings.PAYMENT_QUEUE.get("max_attempts", 3)
+
+  try:
+    if job.contribution is None:
+      # The Contribution was deleted while the job was queued.
+      result = {'status': 'invalid', 'message': 'The contribution was cancelled.'}
+    else:
+      result = process_contribution(job.contribution, job.payment, can_retry)
+
+  except ConnectTimeout:
+    # can_retry said we can try again later. Back off exponentially.
+    backoff = settings.PAYMENT_QUEUE.get("retry_backoff", 10) * 2**(job.attempts - 1)
+    job.state = "queued"
+    job.run_after = now() + timedelta(seconds=backoff)
+    job.save(update_fields=['state', 'run_after'])
+    return
+
+  # If the payment failed validation, the Contribution was deleted (and
+  # the database cleared the job's reference to it).
+  if job.contribution is not None and job.contribution.id is None:
+    job.contribution = None
+
+  # Store the result and forget the credit card information.
+  job.state = "finished"
+  job.result = result
+  job.payment = {}
+  job.save(update_fields=['state', 'result', 'payment'])
+
+def fail_payment_job(job, message):
+  # Finish a job that a worker stopped running partway through, wiping the
+  # payment token. The card may or may not have been charged, so like other
+  # unreportable errors in process_contribution, the error is recorded on
+  # the Contribution to be sorted out by hand and the user is told it went
+  # fine. Returns False if another worker finished the job first.
+  if not PaymentJob.objects.filter(id=job.id, state="running").update(state="finished"):
+    return False
+  job.state = "finished"
+  job.result = {'status': 'ok'}
+  job.payment = {}
+  job.save(update_fields=['result', 'payment'])
+
+  contribution = Contribution.objects.filter(id=job.contribution_id).first()
+  if contribution is not None and not contribution.transaction:
+    contribution.transaction = {
+      "error": {
+        "message": message,
+        "type": "PaymentJob",
+      }
+    }
+    contribution.save(update_fields=['transaction'])
+  return True
+
+def fail_abandoned_payment_jobs():
+  # Finish jobs that have been running for longer than any attempt could
+  # take, because the worker running them stopped. Jobs started before
+  # claimed_at was recorded have no time and are also treated as abandoned.
+  lease = settings.PAYMENT_QUEUE.get("lease", 10*60)
+  from django.db.models import Q
+  abandoned = PaymentJob.objects.filter(state="running")\
+    .filter(Q(claimed_at__lt=now() - timedelta(seconds=lease)) | Q(claimed_at=None))
+  for job in abandoned:
+    if fail_payment_job(job, "The payment worker stopped while running this payment."):
+      print("PaymentJob", job.id, "was abandoned by its worker.", file=sys.stderr)
+
+def payment_job_status(request, key):
+  # Return the result of a queued payment to the client polling
+  # for it, or that it is still queued.
+  job = get_object_or_404(PaymentJob.objects.only('state', 'result'), key=key)
+  if job.state != "finished":
+    return JsonResponse({'status': 'queued'})
+  return JsonResponse(job.result)
+
+def send_receipt(contribution, connection=None):
+  # Send a receipt email. To send many receipts over one connection to
+  # the mail server, pass an open connection from get_connection().
 
-def send_receipt(contribution):
   if contribution.receipt_sent_at:
     # Already sent.
     return "Already sent."
 
   # Construct email.
   from django.template import Template, Context
-  body = Template(contribution.campaign.receipt_template)
-  body = body.render(Context({
-    "contributor": contribution.contributor,
-    "recipients": contribution.recipients,
-    "amount": contribution.amount,
-    "transaction_id": str(contribution.id) + "/" + contribution.transaction.get("line_items", [{}])[0].get("transaction_guid", "0"),
-  }))
+  with timed("render-template"):
+    body = Template(contribution.campaign.receipt_template)
+    body = body.render(Context({
+      "contributor": contribution.contributor,
+      "recipients": contribution.recipients,
+      "amount": contribution.amount,
+      "transaction_id": str(contribution.id) + "/" + contribution.transaction.get("line_items", [{}])[0].get("transaction_guid", "0"),
+    }))
 
   # Send email.
   from django.core.mail import EmailMessage
@@ -450,14 +1151,43 @@ def send_receipt(contribution):
       '%s <%s>' % (contribution.campaign.receipt_sender, settings.RECEIPT_FROM_EMAIL),
       [contribution.contributor["email"]],
       bcc=[settings.RECEIPT_REPLY_TO],
-      reply_to=[settings.RECEIPT_REPLY_TO]
+      reply_to=[settings.RECEIPT_REPLY_TO],
+      connection=connection,
   )
-  msg.send(fail_silently=False)
+  with timed("send-email"):
+    msg.send(fail_silently=False)
 
   # Update database.
   contribution.receipt_sent_at = now()
   contribution.save(update_fields=['receipt_sent_at'])
   return "Sent."
 
+def send_outgoing_receipt(outgoing_receipt, connection):
+  # Send a receipt from the outbox. On success, remove it from the outbox.
+  # On failure, record the error and schedule a retry, backing off
+  # exponentially. Returns whether the receipt was sent.
+  contribution = outgoing_receipt.contribution
+  if not contribution.extra: contribution.extra = { }
+  try:
+    send_receipt(contribution, connection)
+  except Exception as e:
+    outgoing_receipt.attempts += 1
+    outgoing_receipt.last_error = str(e)
+    outgoing_receipt.send_after = now() + timedelta(seconds=
+      settings.RECEIPT_OUTBOX.get("retry_backoff", 60) * 2**(outgoing_receipt.attempts - 1))
+    outgoing_receipt.save(update_fields=['attempts', 'last_error', 'send_after'])
+
+    # Record the error on the Contribution too, as when receipts are
+    # sent during the request.
+    contribution.extra["error_sending_receipt"] = str(e)
+    contribution.save(update_fields=['extra'])
+    return False
+
+  if "error_sending_receipt" in contribution.extra:
+    del contribution.extra["error_sending_receipt"]
+    contribution.save(update_fields=['extra'])
+  outgoing_receipt.delete()
+  return True
+
 def test_error_email(request):
   raise ValueError("This view just sends an error email to the admins.")
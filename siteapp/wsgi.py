@@ -14,3 +14,15 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "siteapp.settings")
 
 application = get_wsgi_application()
+
+# Fetch the Democracy Engine meta info when each uwsgi worker starts rather
+# than during the first request that needs it. This must happen after the
+# fork, in the worker, or else the workers would all share the connections
+# opened by the master. Outside of uwsgi, it's fetched on first use.
+try:
+	from uwsgidecorators import postfork
+except ImportError:
+	pass
+else:
+	from siteapp.views import DemocracyEngineAPI
+	postfork(DemocracyEngineAPI.warm_up)